@@ -0,0 +1,80 @@
+# coding: utf-8
+
+#Compares the peak memory and time of decoding a large json-stat response with
+#decode_json_stat and with pyjstat.from_json_stat. Each decoder runs in a fresh process,
+#and its peak memory is the growth of the maximum resident set size while decoding.
+#
+#Run from the repository root with: python -m benchmarks.bench_decode [number of regions]
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def make_body(n_regions=5000):
+    # A json-stat response shaped like that of 07161, with n_regions regions
+    dims = [('Region', 'region', [f"{i:04d}" for i in range(n_regions)]),
+            ('Trinn', 'grade', ['5', '8', '9']),
+            ('Kjonn', 'sex', ['0', '1', '2']),
+            ('ContentsCode', 'contents', ['Andel']),
+            ('Tid', 'year', [str(year) for year in range(2007, 2019)])]
+
+    dimension = {code: {'label': label,
+                        'category': {'index': {value: i for i, value in enumerate(values)},
+                                     'label': {value: f"{label} {value}" for value in values}}}
+                 for code, label, values in dims}
+    dimension['id'] = [code for code, _, _ in dims]
+    dimension['size'] = [len(values) for _, _, values in dims]
+
+    n = 1
+    for size in dimension['size']:
+        n *= size
+    value = [None if i % 11 == 0 else round(i * 0.37 % 100, 1) for i in range(n)]
+
+    return json.dumps({'dataset': {'dimension': dimension, 'label': 'bench', 'value': value}}).encode('utf-8')
+
+
+def peak_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(decoder, n_regions):
+    body = make_body(n_regions)
+
+    if decoder == 'pyjstat':
+        from collections import OrderedDict
+        from pyjstat import pyjstat
+        decode = lambda: pyjstat.from_json_stat(json.loads(body, object_pairs_hook=OrderedDict))[0]
+    else:
+        from ssb_tables.jsonstat import decode_json_stat
+        decode = lambda: decode_json_stat(body)
+
+    # ssb_tables imports them on first use, which is not what is measured
+    import numpy
+    import pandas
+
+    before = peak_rss()
+    start = time.perf_counter()
+    df = decode()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'rows': len(df), 'seconds': elapsed, 'peak_mb': (peak_rss() - before) / 1024}))
+
+
+def main(n_regions=5000):
+    for decoder in ('pyjstat', 'decode_json_stat'):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_decode',
+                                 '--run', decoder, str(n_regions)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        print(f"  {decoder:<20}{result['rows']:>10} rows{result['seconds'] * 1000:10.0f} ms"
+              f"{result['peak_mb']:10.1f} MB")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+#Times "import ssb_tables" in fresh interpreters with python -X importtime, and lists the modules
+#that take the longest to import. pandas, numpy, requests and pyarrow are imported the first time
+#they are used, not with the package; it fails if one of them is imported anyway.
+#
+#Run from the repository root with: python -m benchmarks.bench_import [runs] [max ms]
+#It exits with status 1 when the median import takes longer than max ms.
+
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY = ['pandas', 'numpy', 'requests', 'pyarrow', 'httpx', 'duckdb', 'asyncio', 'multiprocessing']
+
+
+def import_times():
+    # Self and cumulative microseconds of every module imported with ssb_tables,
+    # and the heavy modules that were imported with it
+    check = f"import ssb_tables, json, sys; print(json.dumps([m for m in {HEAVY!r} if m in sys.modules]))"
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', check],
+                             capture_output=True, text=True, check=True)
+
+    # the modules imported at start up, before ssb_tables, are not counted
+    lines = process.stderr.splitlines()
+    start = max(i for i, line in enumerate(lines) if line.rstrip().endswith('| site'))
+    times = {}
+    for line in lines[start + 1:]:
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times, json.loads(process.stdout)
+
+
+def main(runs=7, max_ms=None):
+    results = [import_times() for _ in range(runs)]
+    totals = [times['ssb_tables'][1] / 1000 for times, _ in results]
+    median = statistics.median(totals)
+    print(f"import ssb_tables: {median:.1f} ms median of {runs} runs ({min(totals):.1f} - {max(totals):.1f} ms)")
+
+    times, heavy = results[totals.index(sorted(totals)[len(totals) // 2])]
+    print(f"  {'module':<40}{'self':>10}{'cumulative':>14}")
+    for name, (own, cumulative) in sorted(times.items(), key=lambda item: -item[1][0])[:15]:
+        print(f"  {name:<40}{own / 1000:>7.1f} ms{cumulative / 1000:>11.1f} ms")
+
+    failed = False
+    if heavy:
+        print(f"Imported with the package: {', '.join(heavy)}")
+        failed = True
+    if max_ms is not None and median > max_ms:
+        print(f"Slower than {max_ms} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]], *[float(arg) for arg in sys.argv[2:3]])
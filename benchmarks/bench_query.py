@@ -0,0 +1,62 @@
+# coding: utf-8
+
+#Times how long it takes to build the query for a table with a large region dimension,
+#comparing build_query with the string based query building that full_json used before.
+#
+#Run from the repository root with: python -m benchmarks.bench_query [number of regions]
+
+import ast
+import sys
+import timeit
+
+from ssb_tables import build_query
+
+
+def make_variables(n_regions):
+    # Variables shaped like those of 07161, with n_regions regions
+    regions = [f"{i:04d}" for i in range(n_regions)]
+    return [
+        {'code': 'Region', 'text': 'region', 'values': regions,
+         'valueTexts': [f"Municipality {code}" for code in regions]},
+        {'code': 'Trinn', 'text': 'grade', 'values': ['5', '8', '9'],
+         'valueTexts': ['5nd grade', '8nd grade', '9nd grade']},
+        {'code': 'Kjonn', 'text': 'sex', 'values': ['0', '1', '2'],
+         'valueTexts': ['Both sexes', 'Males', 'Females']},
+        {'code': 'ContentsCode', 'text': 'contents', 'values': ['Andel'],
+         'valueTexts': ['Pupils (per cent)']},
+        {'code': 'Tid', 'text': 'year', 'values': [str(y) for y in range(2007, 2019)],
+         'valueTexts': [str(y) for y in range(2007, 2019)]},
+    ]
+
+
+def legacy_query(variables):
+    # The query building of full_json before build_query
+    query_element = {}
+    for x in range(len(variables)):
+        query_element[x] = '{{"code": "{code}", "selection": {{"filter": "item", "values": {values} }}}}'.format(
+            code=variables[x]['code'],
+            values=variables[x]['values'])
+        query_element[x] = query_element[x].replace("\'", '"')
+    all_elements = str(list(query_element.values()))
+    all_elements = all_elements.replace("\'", "")
+    query = '{{"query": {all_elements} , "response": {{"format": "json-stat" }}}}'.format(all_elements=all_elements)
+    return ast.literal_eval(query)
+
+
+def main(n_regions=20000, repeat=5, number=10):
+    variables = make_variables(n_regions)
+    assert legacy_query(variables) == build_query(variables)
+
+    print(f"Query for {n_regions} regions, best of {repeat} x {number} runs")
+    for name, func in (('legacy string building', legacy_query),
+                       ('build_query', build_query)):
+        best = min(timeit.repeat(lambda: func(variables), repeat=repeat, number=number))
+        print(f"  {name:<24}{best / number * 1000:10.2f} ms")
+
+    selection = {'Region': variables[0]['valueTexts'][::2]}
+    best = min(timeit.repeat(lambda: build_query(variables, selection), repeat=repeat, number=number))
+    print(f"  {'build_query, by text':<24}{best / number * 1000:10.2f} ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
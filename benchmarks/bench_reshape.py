@@ -0,0 +1,78 @@
+# coding: utf-8
+
+#Times the clean-up of a downloaded table on a synthetic frame of about a million rows,
+#comparing apply_spec with the per-table function it replaced (get_frame_from_10793).
+#
+#Run from the repository root with: python -m benchmarks.bench_reshape [number of backgrounds]
+
+import itertools
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ssb_tables import TABLE_SPECS, apply_spec
+
+
+def make_frame(n_backgrounds=2000):
+    # A frame shaped like the download of 10793, in the order of a json-stat response
+    dims = [['5nd grade', '8nd grade', '9nd grade'],
+            ['English', 'Reading', 'Numeracy'],
+            [f"background {i}" for i in range(n_backgrounds)],
+            ['Both sexes', 'Males', 'Females'],
+            ['Score points', 'Pupils (persons)'],
+            [str(year) for year in range(2009, 2019)]]
+    rows = list(itertools.product(*dims))
+    df = pd.DataFrame(rows, columns=['grade', 'test', 'background', 'sex', 'contents', 'year'])
+    df['value'] = np.random.default_rng(0).random(len(df)) * 100
+    return df
+
+
+def legacy_10793(df):
+    # The body of get_frame_from_10793 before the table specs
+    df.columns = ["grade", "test", 'background', "sex", "contents", "year", "value"]
+    df.grade = df.grade.str.replace("nd", "th")
+
+    df_score = df.rename(columns={'value': 'score'})
+    df_score = df_score[df_score.contents == 'Score points']
+    df_score.reset_index(drop=True, inplace=True)
+
+    df_pupils = df.rename(columns={'value': 'pupils'})
+    df_pupils = df_pupils[df_pupils.contents == 'Pupils (persons)']
+    df_pupils.reset_index(drop=True, inplace=True)
+
+    return pd.concat([df_score, df_pupils.pupils], axis=1).drop(columns=['contents'])
+
+
+def best_time(func, df, repeat=3):
+    times = []
+    for _ in range(repeat):
+        frame = df.copy()
+        start = time.perf_counter()
+        result = func(frame)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(n_backgrounds=2000):
+    df = make_frame(n_backgrounds)
+    print(f"Reshaping {len(df)} rows")
+
+    legacy_time, legacy = best_time(legacy_10793, df)
+    spec_time, result = best_time(lambda frame: apply_spec(frame, TABLE_SPECS["10793"]), df)
+    assert legacy.equals(result)
+
+    # rows in any other order go through the general pivot
+    shuffled = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    pivot_time, pivoted = best_time(lambda frame: apply_spec(frame, TABLE_SPECS["10793"]), shuffled)
+    keys = ['grade', 'test', 'background', 'sex', 'year']
+    assert pivoted.sort_values(keys, ignore_index=True).equals(result.sort_values(keys, ignore_index=True))
+
+    print(f"  {'get_frame_from_10793':<24}{legacy_time * 1000:10.1f} ms")
+    print(f"  {'apply_spec':<24}{spec_time * 1000:10.1f} ms")
+    print(f"  {'apply_spec, shuffled':<24}{pivot_time * 1000:10.1f} ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+#Publishes the tables of TABLE_SPECS, replayed at a scale (see fixtures.py), with publish_tables and
+#starts worker processes that either attach to them (attach_table) or read a copy of their own
+#(read_table). Reports how long loading takes in each worker and how much memory each worker holds
+#privately, which grows with the workers for copies but not for attached tables.
+#
+#Run from the repository root with: python -m benchmarks.bench_shared [number of workers] [scale]
+#Needs pyarrow and linux (/proc/self/smaps_rollup).
+
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import ssb_tables
+from ssb_tables import TABLE_SPECS, attach_table, publish_tables, read_table, set_catalog, set_client
+
+from .fixtures import replay_client
+
+
+def memory_kb():
+    # Private and proportional set size of this process, in kilobytes
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                sizes[parts[0][:-1]] = int(parts[1])
+    return sizes['Private_Clean'] + sizes['Private_Dirty'], sizes['Pss']
+
+
+def work(mode, folder):
+    # A worker: load every table, touch all of it, report time and memory.
+    # pandas is imported before the baseline, as ssb_tables imports it on first use
+    import numpy
+    import pandas
+
+    before, _ = memory_kb()
+    start = time.perf_counter()
+    if mode == 'attach':
+        tables = [attach_table(table_id, folder) for table_id in TABLE_SPECS]
+    else:
+        tables = [read_table(table_id, folder, format='feather').copy() for table_id in TABLE_SPECS]
+    elapsed = time.perf_counter() - start
+
+    rows = sum(len(df) for df in tables)
+    total = sum(float(df[df.columns[-1]].sum()) for df in tables)
+    private, pss = memory_kb()
+    print(json.dumps({'seconds': elapsed, 'rows': rows, 'total': total,
+                      'private_mb': (private - before) / 1024, 'pss_mb': pss / 1024}))
+    sys.stdout.flush()
+    # stay alive until told to go, so that the workers overlap
+    sys.stdin.read()
+
+
+def main(n_workers=4, scale=16):
+    folder = tempfile.mkdtemp(prefix='ssb_tables_', dir='/dev/shm')
+
+    previous = ssb_tables.get_client(), ssb_tables.get_catalog()
+    set_client(replay_client(scale=scale))
+    set_catalog(None)
+    try:
+        start = time.perf_counter()
+        publish_tables(folder)
+        print(f"Published {len(TABLE_SPECS)} tables at scale {scale} in {time.perf_counter() - start:.2f} s")
+    finally:
+        set_client(previous[0])
+        set_catalog(previous[1])
+
+    try:
+        compare(folder, n_workers)
+    finally:
+        shutil.rmtree(folder)
+
+
+def compare(folder, n_workers):
+    for mode in ('attach', 'copy'):
+        workers = [subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_shared', '--work', mode, folder],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                   for _ in range(n_workers)]
+        results = [json.loads(worker.stdout.readline()) for worker in workers]
+        for worker in workers:
+            worker.communicate('')
+
+        assert len({(result['rows'], round(result['total'], 3)) for result in results}) == 1
+        seconds = sum(result['seconds'] for result in results) / n_workers
+        private = sum(result['private_mb'] for result in results)
+        print(f"  {mode:<8}{n_workers} workers, {results[0]['rows']} rows each: "
+              f"{seconds * 1000:8.1f} ms to load, {private:8.1f} MB private in all")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--work']:
+        work(sys.argv[2], sys.argv[3])
+    else:
+        main(*map(int, sys.argv[1:3]))
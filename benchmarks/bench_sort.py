@@ -0,0 +1,65 @@
+# coding: utf-8
+
+#Times the sorting of a large table in get_table, comparing sort_table with the
+#per-column sort it replaced, and checks that sort_table keeps the rows whole.
+#
+#Run from the repository root with: python -m benchmarks.bench_sort [number of regions]
+
+import itertools
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ssb_tables import sort_table
+
+
+def make_frame(n_regions=5000):
+    # A cleaned-up table shaped like 07161, with categorical dimensions
+    dims = {'region': [f"region {i}" for i in range(n_regions)],
+            'grade': ['5th grade', '8th grade', '9th grade'],
+            'test': ['English', 'Reading', 'Numeracy'],
+            'sex': ['Both sexes', 'Boys', 'Girls'],
+            'year': [str(year) for year in range(2007, 2019)]}
+    rows = list(itertools.product(*dims.values()))
+    df = pd.DataFrame(rows, columns=list(dims))
+    for column, categories in dims.items():
+        df[column] = pd.Categorical(df[column], categories=categories)
+    df['percent'] = np.random.default_rng(0).random(len(df)) * 100
+    return df
+
+
+def legacy_sort(df):
+    # The sort of get_table before sort_table
+    return pd.DataFrame({x: df[x].sort_values().values for x in df.columns.values})
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(n_regions=5000):
+    df = make_frame(n_regions)
+    by = ['region', 'grade', 'test', 'sex', 'year']
+    shuffled = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    print(f"Sorting {len(df)} rows")
+
+    legacy_time, _ = timed(legacy_sort, shuffled)
+    sort_time, result = timed(sort_table, shuffled, by)
+    sorted_time, _ = timed(sort_table, df, by)
+
+    # every row still has its own measure, and the rows are in order
+    assert result.equals(df)
+    merged = shuffled.merge(result, on=by, suffixes=('_before', '_after'))
+    assert (merged['percent_before'] == merged['percent_after']).all()
+
+    print(f"  {'per-column sort':<28}{legacy_time * 1000:10.1f} ms")
+    print(f"  {'sort_table':<28}{sort_time * 1000:10.1f} ms")
+    print(f"  {'sort_table, already sorted':<28}{sorted_time * 1000:10.1f} ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
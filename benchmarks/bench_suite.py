@@ -0,0 +1,141 @@
+# coding: utf-8
+
+#Times every table of TABLE_SPECS end to end against replayed responses (see fixtures.py;
+#synthetic tables unless recordings were made), at several scale factors: full_json, read_all
+#(request and decode), the reshape of apply_spec, get_table and the export, with the peak
+#memory traced while getting and exporting the table.
+#
+#Run from the repository root with: python -m benchmarks.bench_suite [--scales 1 4 16]
+#Save the results with --save results.json, and compare a later run with --compare results.json;
+#it exits with status 1 when a timing is slower than the baseline by more than the tolerance.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# imported up front, as ssb_tables only imports them on first use and the
+# first table timed would pay for it
+import numpy
+import pandas
+
+import ssb_tables
+from ssb_tables import (TABLE_SPECS, Metrics, apply_spec, full_json, get_table, read_all,
+                        set_catalog, set_client, set_single_flight, write_table)
+
+from .fixtures import FIXTURE_DIR, replay_client
+
+TIMINGS = ['full_json', 'read_all', 'decode', 'reshape', 'sort', 'get_table', 'export']
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def export(df, folder, table_id):
+    # parquet when pyarrow is there, like create_all_tables(format='parquet')
+    try:
+        write_table(df, os.path.join(folder, f"table_{table_id}.parquet"), 'parquet', table_id=table_id)
+    except ImportError:
+        df.astype(str).to_csv(os.path.join(folder, f"table_{table_id}.csv"), index=False)
+
+
+def bench_table(table_id, folder):
+    result = {}
+    result['full_json'], _ = timed(full_json, table_id)
+    result['read_all'], raw = timed(read_all, table_id)
+    result['reshape'], _ = timed(apply_spec, raw, TABLE_SPECS[table_id])
+
+    with Metrics() as metrics:
+        result['get_table'], df = timed(get_table, table_id)
+    result['decode'] = metrics.stages[table_id]['decode']
+    result['sort'] = metrics.stages[table_id]['sort']
+    result['export'], _ = timed(export, df, folder, table_id)
+    result['rows'] = len(df)
+
+    # traced separately, as tracing slows everything down
+    del raw, df
+    tracemalloc.start()
+    export(get_table(table_id), folder, table_id)
+    result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+
+    return result
+
+
+def run(scales, table_ids=None, folder=FIXTURE_DIR):
+    table_ids = table_ids or list(TABLE_SPECS)
+    results = {}
+
+    # every request goes to the replayed responses, and is done each time
+    previous = ssb_tables.get_client(), ssb_tables.get_catalog(), ssb_tables._FLIGHT
+    set_catalog(None)
+    set_single_flight(None)
+    try:
+        for scale in scales:
+            set_client(replay_client(table_ids, scale, folder))
+            print(f"Scale {scale}")
+            print(f"  {'table':<8}{'rows':>9}" + "".join(f"{name:>11}" for name in TIMINGS) + f"{'peak MB':>10}")
+
+            with tempfile.TemporaryDirectory() as tmp:
+                for table_id in table_ids:
+                    result = results[f"{table_id}@{scale}"] = bench_table(table_id, tmp)
+                    print(f"  {table_id:<8}{result['rows']:>9}"
+                          + "".join(f"{result[name] * 1000:>8.1f} ms" for name in TIMINGS)
+                          + f"{result['peak_mb']:>10.1f}")
+    finally:
+        set_client(previous[0])
+        set_catalog(previous[1])
+        set_single_flight(previous[2])
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, noise=0.005):
+    # The timings and peaks that got worse than the baseline by more than the
+    # tolerance, ignoring differences below noise seconds
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        for name in TIMINGS:
+            if result[name] > before[name] * (1 + tolerance) and result[name] - before[name] > noise:
+                regressions.append(f"{key} {name}: {before[name] * 1000:.1f} ms -> {result[name] * 1000:.1f} ms")
+        if result['peak_mb'] > before['peak_mb'] * (1 + tolerance):
+            regressions.append(f"{key} peak: {before['peak_mb']:.1f} MB -> {result['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of every table")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--tables', nargs='+', default=None)
+    parser.add_argument('--fixtures', default=FIXTURE_DIR)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run(args.scales, args.tables, args.fixtures)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
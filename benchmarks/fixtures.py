@@ -0,0 +1,245 @@
+# coding: utf-8
+
+#Recorded and synthetic responses of the Statistics Norway API, replayed through a requests
+#transport adapter so that benchmarks never touch the network.
+#
+#No recordings are committed, so out of the box every table is synthesized from its spec: its
+#columns and labels are those of the real table, its values and sizes are made up. Record the
+#tables of TABLE_SPECS from data.ssb.no into benchmarks/fixtures/ with:
+#python -m benchmarks.fixtures [table ids]
+#Recorded tables are then replayed instead of synthetic ones.
+
+import fnmatch
+import gzip
+import json
+import os
+import sys
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from ssb_tables import COUNT_MEASURES, TABLE_SPECS, SSBClient, full_json, get_client
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Labels of the synthetic dimensions, with the spellings the string fixes expect
+_LABELS = {'grade': ["5nd grade", "8nd grade", "9nd grade"],
+           'sex': ["Both sexes", "Males", "Females"],
+           'year': [str(year) for year in range(2007, 2019)]}
+_CODES = {'region': 'Region', 'year': 'Tid', 'contents': 'ContentsCode'}
+
+
+def record(table_ids=None, folder=FIXTURE_DIR, client=None):
+    """
+        Downloads the metadata and the whole json-stat response of each
+        table and saves them to {folder}/{table_id}.json.gz.
+        """
+    client = client or get_client()
+    os.makedirs(folder, exist_ok=True)
+
+    for table_id in table_ids or TABLE_SPECS:
+        url = client.table_url(table_id)
+        metadata = json.loads(client.fetch('GET', url))
+        dataset = json.loads(client.fetch('POST', url, query=full_json(table_id, client=client)))
+        with gzip.open(os.path.join(folder, f"{table_id}.json.gz"), 'wt', encoding='utf-8') as f:
+            json.dump({'metadata': metadata, 'dataset': dataset}, f, ensure_ascii=False)
+        print(f"Recorded {table_id}")
+
+
+def synthetic(table_id, scale=1):
+    """
+        Makes up the metadata and json-stat response of a table from its
+        spec: a variable per column but the last, with the labels the
+        string fixes and measures expect. The regions, or the first
+        dimension of tables without regions, grow with the scale.
+        """
+    spec = TABLE_SPECS[table_id]
+    columns = spec['columns'][:-1]
+
+    variables = []
+    for i, column in enumerate(columns):
+        if column == 'contents':
+            texts = list(spec.get('measures') or ["Contents"])
+        elif column == 'region':
+            texts = [f"Region {j}" for j in range(25 * scale)]
+        elif column in _LABELS:
+            texts = _LABELS[column]
+        else:
+            texts = [f"{column} {j}" for j in range(2)]
+
+        if i == 0 and column != 'region' and 'region' not in columns:
+            texts = [f"{text} ({k})" if k else text for k in range(scale) for text in texts]
+
+        values = texts if column == 'year' else [f"{j:04d}" for j in range(len(texts))]
+        variables.append({'code': _CODES.get(column, column.capitalize()), 'text': column,
+                          'values': values, 'valueTexts': texts})
+
+    sizes = [len(variable['values']) for variable in variables]
+    rng = np.random.default_rng(int(table_id))
+    values = np.round(rng.random(sizes) * 100, 1)
+
+    # counts are whole numbers
+    if 'contents' in columns and spec.get('measures'):
+        axis = columns.index('contents')
+        for i, text in enumerate(variables[axis]['valueTexts']):
+            if spec['measures'].get(text) in COUNT_MEASURES:
+                index = (slice(None),) * axis + (i,)
+                values[index] = np.round(values[index] * 10)
+
+    values = values.ravel()
+    values[rng.random(len(values)) < 0.05] = np.nan
+
+    return {'metadata': {'title': f"{table_id}: Synthetic table {table_id}", 'variables': variables},
+            'variables': variables, 'values': values.reshape(sizes)}
+
+
+def load(table_id, scale=1, folder=FIXTURE_DIR):
+    """
+        Returns the recorded fixture of a table, its first dimension
+        repeated scale times, or a synthetic one if there is no recording.
+        """
+    path = os.path.join(folder, f"{table_id}.json.gz")
+    if not os.path.exists(path):
+        return synthetic(table_id, scale)
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        recording = json.load(f)
+
+    dataset = recording['dataset']['dataset'] if 'dataset' in recording['dataset'] else recording['dataset']
+    dimension = dataset['dimension']
+    by_code = {variable['code']: variable for variable in recording['metadata']['variables']}
+    variables = [by_code[code] for code in dimension['id']]
+
+    # values come as a list, or as a dict of the positions that have one
+    if isinstance(dataset['value'], dict):
+        values = np.full(int(np.prod(dimension['size'])), np.nan)
+        for position, value in dataset['value'].items():
+            values[int(position)] = np.nan if value is None else value
+    else:
+        values = np.array([np.nan if value is None else value for value in dataset['value']], dtype=float)
+    values = values.reshape(dimension['size'])
+
+    if scale > 1:
+        first = variables[0]
+        variables[0] = dict(first,
+                            values=[f"{value}#{k}" if k else value for k in range(scale) for value in first['values']],
+                            valueTexts=[f"{text} ({k})" if k else text for k in range(scale) for text in first['valueTexts']])
+        values = np.concatenate([values] * scale, axis=0)
+
+    return {'metadata': dict(recording['metadata'], variables=variables), 'variables': variables, 'values': values}
+
+
+def response_body(fixture, query):
+    # The json-stat response to a query: the values of the selected categories
+    dimension = {'id': [], 'size': []}
+    values = fixture['values']
+    selections = {element['code']: element['selection'] for element in query['query']}
+
+    for axis, variable in enumerate(fixture['variables']):
+        code = variable['code']
+        positions = _select(variable['values'], selections.get(code))
+        values = np.take(values, positions, axis=axis)
+
+        codes = [variable['values'][i] for i in positions]
+        dimension[code] = {'label': variable['text'],
+                           'category': {'index': {value: i for i, value in enumerate(codes)},
+                                        'label': {variable['values'][i]: variable['valueTexts'][i]
+                                                  for i in positions}}}
+        dimension['id'].append(code)
+        dimension['size'].append(len(positions))
+
+    flat = values.ravel()
+    value = np.where(np.isnan(flat), None, flat).tolist()
+    return json.dumps({'dataset': {'dimension': dimension, 'label': fixture['metadata']['title'],
+                                   'value': value}}).encode('utf-8')
+
+
+def _select(values, selection):
+    # Positions of the values a selection of a query picks
+    if selection is None:
+        return list(range(len(values)))
+    if selection['filter'] == 'item':
+        position = {value: i for i, value in enumerate(values)}
+        return [position[value] for value in selection['values']]
+    if selection['filter'] == 'all':
+        return [i for i, value in enumerate(values)
+                if any(fnmatch.fnmatchcase(value, pattern) for pattern in selection['values'])]
+    if selection['filter'] == 'top':
+        return list(range(len(values)))[-int(selection['values'][0]):]
+    raise ValueError(f"Replaying {selection['filter']!r} filters is not supported")
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+        A requests transport adapter that answers the table, metadata and
+        search requests of the API from fixtures, mapping table ids to the
+        fixtures of load or synthetic. The responses to whole tables are
+        encoded once and kept.
+        """
+
+    def __init__(self, fixtures):
+        super().__init__()
+        self.fixtures = fixtures
+        self._bodies = {}
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        parts = url.path.rstrip('/').split('/')
+
+        if 'query' in parse_qs(url.query):
+            phrase = parse_qs(url.query)['query'][0]
+            results = [{'id': table_id, 'title': fixture['metadata']['title'],
+                        'published': '2019-01-01T00:00:00'}
+                       for table_id, fixture in self.fixtures.items() if phrase in (table_id, '*')]
+            return self._response(request, json.dumps(results).encode('utf-8'))
+
+        table_id = parts[-1]
+        fixture = self.fixtures.get(table_id)
+        if fixture is None:
+            return self._response(request, b'', status=404)
+
+        if request.method == 'GET':
+            return self._response(request, json.dumps(fixture['metadata']).encode('utf-8'))
+
+        body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+        if body not in self._bodies:
+            query = json.loads(body)
+            response = response_body(fixture, query)
+            whole = all(element['selection'] == {'filter': 'item', 'values': variable['values']}
+                        for element, variable in zip(query['query'], fixture['variables']))
+            if not whole:
+                return self._response(request, response)
+            self._bodies[body] = response
+        return self._response(request, self._bodies[body])
+
+    def _response(self, request, body, status=200):
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json',
+                                                'Content-Length': str(len(body))})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def replay_client(table_ids=None, scale=1, folder=FIXTURE_DIR, **kwargs):
+    """
+        Returns an SSBClient whose requests are answered from the fixtures
+        of the tables at the scale, see load.
+        """
+    client = SSBClient(**kwargs)
+    fixtures = {table_id: load(table_id, scale, folder) for table_id in table_ids or TABLE_SPECS}
+    client.session.mount(client.base_url, ReplayAdapter(fixtures))
+    return client
+
+
+if __name__ == '__main__':
+    record(sys.argv[1:] or None)
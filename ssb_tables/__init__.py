@@ -3,90 +3,427 @@
 #ssb
 #A conventient way to retrieve DataFrames from a selected set of tables from the Norwegian Bureau of Statistics
 
-import pandas as pd
-import requests
-import ast
-from pyjstat import pyjstat
-from collections import OrderedDict
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from collections.abc import Mapping
+from functools import partial
+from .lazy import LazyModule
+from .cache import cache_key, ResponseCache, FileCache, SQLiteCache
+from .client import BASE_URL, RateLimiter, SSBClient
+from .jsonstat import decode_json_stat
+from .catalog import Catalog
+from .local import LocalTable, open_table, scan_table
+from .singleflight import SingleFlight
+from .storage import Storage, DirectoryStorage, SQLiteStorage, DuckDBStorage
+from .search_index import SearchIndex, search_index
+from . import metrics
+from .metrics import Metrics
+
+# pandas, numpy and requests are imported the first time they are used, so
+# that importing ssb_tables is quick, see benchmarks/bench_import.py
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+
+
+# Queries estimated to ask for more cells than this are split into several
+# smaller queries, see read_all and read_with_json
+MAX_CELLS = 800000
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_CLIENT = None
+_CATALOG = None
+
+# Concurrent identical calls of get_table and read_all share one download
+_FLIGHT = SingleFlight()
+
+
+def get_client():
+    """
+        Returns the SSBClient used by functions that are not given one,
+        creating it on first use.
+        """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = SSBClient()
+    return _CLIENT
+
+
+def set_client(client):
+    """
+        Sets the SSBClient used by functions that are not given one.
+        """
+    global _CLIENT
+    _CLIENT = client
+
+
+def set_catalog(catalog):
+    """
+        Sets the metadata Catalog that get_variables, full_json and
+        get_table_titles read from. Pass None to fetch metadata every time.
+        """
+    global _CATALOG
+    _CATALOG = catalog
+
+
+def get_catalog():
+    return _CATALOG
+
+
+def set_single_flight(flight):
+    """
+        Sets the SingleFlight that coalesces concurrent identical calls of
+        get_table and read_all. Pass None to let every call do its own
+        download.
+
+        Example
+        -------
+
+            # also make processes sharing a FileCache wait for each other
+            set_single_flight(SingleFlight(lock_dir="~/.cache/ssb_tables/locks"))
+        """
+    global _FLIGHT
+    _FLIGHT = flight
+
+
+def _coalesce(key, func):
+    # Runs func, or waits for the identical call that is already running
+    if _FLIGHT is None:
+        return func()
+    return _FLIGHT.do(json.dumps(key, sort_keys=True, default=repr), func)
+
+
+def set_cache(cache):
+    """
+        Sets the response cache of the default client, used by get_variables,
+        read_with_json, read_all and search. Pass None to turn caching off.
+
+        Example
+        -------
+
+            set_cache(FileCache("~/.cache/ssb_tables", ttl=3600))
+        """
+    get_client().cache = cache
 
 
 def get_variables(
         table_id=None,
         source=None,
-        language='en',
-        base_url='http://data.ssb.no/api/v0',
-        full_url=None):
+        language=None,
+        base_url=None,
+        full_url=None,
+        client=None):
 
+    # tables of the default api are looked up in the catalog, when one is set
+    if _CATALOG is not None and table_id is not None and full_url is None and base_url is None:
+        return _CATALOG.variables(table_id, language)
 
+    client = client or get_client()
     if full_url is None:
-        full_url = '{base_url}/{language}/table/{table_id}'.format(
-            base_url=base_url, language=language, table_id=table_id)
+        full_url = client.table_url(table_id, language, base_url)
 
-    df = pd.read_json(full_url)
-    variables = [dict(values) for values in df.iloc[:, 1]]
+    with metrics.stage('metadata'):
+        variables = json.loads(client.fetch('GET', full_url, language=language))['variables']
 
     return variables
 
 def read_with_json(table_id=None,
                    query=None,
-                   language='en',
-                   base_url='http://data.ssb.no/api/v0',
-                   full_url=None):
+                   language=None,
+                   base_url=None,
+                   full_url=None,
+                   client=None,
+                   max_cells=None,
+                   selections=None):
+
+    with metrics.table_context(table_id):
+        return _read_with_json(table_id, query, language, base_url, full_url, client, max_cells, selections)
+
+
+def _read_with_json(table_id, query, language, base_url, full_url, client, max_cells, selections):
+    # without a query, build one from the selections, see build_query
+    if query is None:
+        variables = get_variables(table_id, language=language, base_url=base_url,
+                                  full_url=full_url, client=client)
+        query = build_query(variables, selections)
 
+    client = client or get_client()
     if full_url is None:
-        full_url = '{base_url}/{language}/table/{table_id}'.format(
-            base_url=base_url,
-            language=language,
-            table_id=table_id)
+        full_url = client.table_url(table_id, language, base_url)
+
+    return _post_query(client, full_url, query, language, max_cells)
+
+
+def estimate_cells(query):
+    """
+        Returns the number of cells a query asks for, or None when that
+        cannot be told from the query alone (filters other than item and top).
+        """
+    cells = 1
+    for element in query['query']:
+        selection = element['selection']
+        if selection['filter'] == 'item':
+            cells *= len(selection['values'])
+        elif selection['filter'] == 'top':
+            cells *= int(selection['values'][0])
+        else:
+            return None
+    return cells
+
+
+def split_query(query, max_cells=None):
+    """
+        Splits a query into smaller queries of at most max_cells cells each,
+        by cutting the selection of the largest dimension into slices (and
+        the next largest, if that is not enough).
+
+        Returns a list of (query, offsets) pairs, where offsets holds the
+        position of each chunk's first value in every dimension.
+        Queries that cannot be split are returned as the only chunk.
+        """
+    max_cells = max_cells or MAX_CELLS
+    elements = query['query']
+    offsets = [0] * len(elements)
+
+    if any(element['selection']['filter'] != 'item' for element in elements):
+        return [(query, offsets)]
+
+    sizes = [len(element['selection']['values']) for element in elements]
+    cells = estimate_cells(query)
+    if cells <= max_cells or max(sizes) <= 1:
+        return [(query, offsets)]
+
+    dim = int(np.argmax(sizes))
+    step = max(1, max_cells // (cells // sizes[dim]))
+    values = elements[dim]['selection']['values']
+
+    chunks = []
+    for start in range(0, sizes[dim], step):
+        element = dict(elements[dim])
+        element['selection'] = dict(element['selection'], values=values[start:start + step])
+        sub_query = dict(query, query=elements[:dim] + [element] + elements[dim + 1:])
+
+        for chunk, chunk_offsets in split_query(sub_query, max_cells):
+            chunk_offsets[dim] += start
+            chunks.append((chunk, chunk_offsets))
+
+    return chunks
+
+
+def _post_query(client, full_url, query, language=None, max_cells=None, ordered=False):
+    # Posts the query, split into chunks that are fetched in parallel when it
+    # asks for more than max_cells cells. With ordered=True the query must list
+    # the variables in table order, and the rows are put back in the order a
+    # single response would have had.
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(chunk):
+        with metrics.stage('post'):
+            data = client.fetch('POST', full_url, query=chunk, language=language)
+        with metrics.stage('decode'):
+            return decode_json_stat(data)
+
+    chunks = split_query(query, max_cells)
+    if len(chunks) == 1:
+        return fetch(query)
+
+    with ThreadPoolExecutor(max_workers=client.limiter.max_per_host) as executor:
+        frames = list(executor.map(metrics.bind(fetch), [chunk for chunk, _ in chunks]))
+    return _assemble_chunks(frames, chunks, query, ordered)
+
+
+def _assemble_chunks(frames, chunks, query, ordered=False):
+    # Concatenates the frames of the chunks of a query, see split_query,
+    # putting the rows back in the order of a single response if ordered
+    df = _concat_frames(frames)
+
+    if not ordered:
+        return df
+
+    sizes = [len(element['selection']['values']) for element in query['query']]
+    positions = []
+    for frame, (chunk, offsets) in zip(frames, chunks):
+        shape = [len(element['selection']['values']) for element in chunk['query']]
+        if len(frame) != int(np.prod(shape)) or len(frame.columns) != len(shape) + 1:
+            return df
+        index = np.unravel_index(np.arange(len(frame)), shape)
+        positions.append(np.ravel_multi_index(
+            [i + offset for i, offset in zip(index, offsets)], sizes))
+
+    order = np.argsort(np.concatenate(positions), kind='stable')
+    return df.take(order).reset_index(drop=True)
+
+
+def top(n):
+    """
+        Selection of the n last values of a variable, typically the most
+        recent years. For use with build_query.
+        """
+    return {'filter': 'top', 'values': [str(n)]}
+
+
+def agg(aggregation, values):
+    """
+        Selection of values from one of the table's aggregations, e.g.
+        agg("KommSummer", ["K-0301"]). For use with build_query.
+        """
+    return {'filter': 'agg:' + aggregation, 'values': list(values)}
+
+
+def build_query(variables, selections=None):
+    """
+        Builds a json-stat query from the variables of a table, as returned by
+        get_variables, checking the selections against them.
+
+        Example
+        -------
+
+            variables = get_variables("07161")
+            query = build_query(variables, {"Region": ["0", "03"],
+                                            "Tid": top(3)})
+            df = read_with_json("07161", query)
+
+
+        Parameters
+        ----------
+
+        variables: list
+            The variables of the table, from get_variables.
+
+        selections: dict
+            Maps variable codes to the values to select. Variables that are
+            left out get all their values.
+            A list selects those values (item filter); value texts are
+            translated to their codes.
+            "*", or a pattern such as "03*", selects all matching values
+            (all filter).
+            top(n) and agg(aggregation, values) select the n last values
+            and values from an aggregation.
+        """
+    selections = dict(selections or {})
+    by_code = {variable['code']: variable for variable in variables}
+
+    unknown = set(selections) - set(by_code)
+    if unknown:
+        raise ValueError(f"Unknown variables {sorted(unknown)}, "
+                         f"expected some of {list(by_code)}")
+
+    elements = []
+    for variable in variables:
+        code = variable['code']
+        selection = selections.get(code)
+
+        if selection is None:
+            selection = {'filter': 'item', 'values': list(variable['values'])}
+        elif isinstance(selection, str):
+            selection = {'filter': 'all', 'values': [selection]}
+        elif isinstance(selection, dict):
+            selection = dict(selection)
+        else:
+            selection = {'filter': 'item', 'values': list(selection)}
+
+        _validate_selection(variable, selection)
+        elements.append({'code': code, 'selection': selection})
+
+    return {'query': elements, 'response': {'format': 'json-stat'}}
+
+
+def _validate_selection(variable, selection):
+    # Checks a selection against the variable's metadata, translating value
+    # texts in item selections into value codes
+    code = variable['code']
+    kind = selection.get('filter')
+    values = selection.get('values')
+
+    if not isinstance(values, list):
+        raise ValueError(f"Selection of {code} has no list of values")
+
+    if kind == 'item':
+        codes = set(variable['values'])
+        texts = dict(zip(variable.get('valueTexts', []), variable['values']))
+        translated = []
+        for value in values:
+            value = str(value)
+            if value not in codes and value in texts:
+                value = texts[value]
+            if value not in codes:
+                raise ValueError(f"{value!r} is not a value of {code}")
+            translated.append(value)
+        selection['values'] = translated
+
+    elif kind == 'top':
+        if len(values) != 1 or not str(values[0]).isdigit() or int(values[0]) < 1:
+            raise ValueError(f"top selection of {code} needs one positive count")
+        if int(values[0]) > len(variable['values']):
+            raise ValueError(f"{code} has only {len(variable['values'])} values")
+
+    elif kind != 'all' and not str(kind).startswith('agg:'):
+        raise ValueError(f"Unknown filter {kind!r} for {code}")
+
+
+def _concat_frames(frames):
+    # Concatenates decoded frames, keeping the dimensions categorical
+    columns = {}
+    for column in frames[0].columns:
+        parts = [frame[column] for frame in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[column] = pd.api.types.union_categoricals([part.array for part in parts])
+        else:
+            columns[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
 
-    data = requests.post(full_url, json=query)
-    results = pyjstat.from_json_stat(data.json(object_pairs_hook=OrderedDict))
-    return results[0]
 
 def full_json(table_id=None,
               out='dict',
-              language='en',
-              full_url=None):
+              language=None,
+              full_url=None,
+              client=None,
+              base_url=None):
 
 
-    variables = get_variables(table_id, language=language, full_url=full_url)
-    nvars = len(variables)
-    var_list = list(range(nvars))
+    variables = get_variables(table_id, language=language, base_url=base_url,
+                              full_url=full_url, client=client)
+    query = build_query(variables)
 
-    query_element = {}
+    if out != 'dict':
+        query = json.dumps(query)
 
-    for x in var_list:
-        query_element[x] = '{{"code": "{code}", "selection": {{"filter": "item", "values": {values} }}}}'.format(
-            code=variables[x]['code'],
-            values=variables[x]['values'])
-        query_element[x] = query_element[x].replace("\'", '"')
-    all_elements = str(list(query_element.values()))
-    all_elements = all_elements.replace("\'", "")
+    return query
 
-    query = '{{"query": {all_elements} , "response": {{"format": "json-stat" }}}}'.format(all_elements=all_elements)
 
-    if out == 'dict':
-        query = ast.literal_eval(query)
+def read_all(table_id=None,
+             language=None,
+             base_url=None,
+             full_url=None,
+             client=None,
+             max_cells=None):
 
-    return query
+    client = client or get_client()
+    url = full_url or client.table_url(table_id, language, base_url)
 
+    return _coalesce(['read_all', url, language or client.language, max_cells],
+                     lambda: _read_all(table_id, language, base_url, full_url, client, max_cells))
 
 
-def read_all(table_id=None,
-             language='en',
-             base_url='http://data.ssb.no/api/v0',
-             full_url=None):
+def _read_all(table_id, language, base_url, full_url, client, max_cells):
+    with metrics.table_context(table_id):
+        return _post_all(table_id, language, base_url, full_url, client, max_cells)
+
 
+def _post_all(table_id, language, base_url, full_url, client, max_cells):
+    query = full_json(table_id, language=language, base_url=base_url, full_url=full_url, client=client)
 
     if full_url is None:
-        full_url = '{base_url}/{language}/table/{table_id}'.format(
-            base_url=base_url,
-            language=language,
-            table_id=table_id)
+        full_url = client.table_url(table_id, language, base_url)
 
-    query = full_json(full_url=full_url)
-    data = requests.post(full_url, json=query)
-    results = pyjstat.from_json_stat(data.json(object_pairs_hook=OrderedDict))
+    # large tables are fetched in chunks of at most max_cells cells
+    result = _post_query(client, full_url, query, language, max_cells, ordered=True)
 
     # maybe this need not be its own function,
     # but an option in read_json? json = 'all'
@@ -94,12 +431,14 @@ def read_all(table_id=None,
     # other functions(options include: read_recent to get only the
     # most recent values (defined as x), json = 'recent')
 
-    return results[0]
+    return result
 
 
 def search(phrase,
-           language='en',
-           base_url='http://data.ssb.no/api/v0'):
+           language=None,
+           base_url=None,
+           client=None,
+           offline=False):
     """
         Search for tables that contain the phrase in Statistics Norway.
         Returns a pandas dataframe with the results.
@@ -126,32 +465,54 @@ def search(phrase,
         language: string
             default in Statistics Norway: 'en' (Search for English words)
             optional in Statistics Norway: 'no' (Search for Norwegian words)
+            None uses the language of the client
 
         url: string
             default in Statistics Norway: 'http://data.ssb.no/api/v0'
             different defaults can be specified
+            None uses the base_url of the client
+
+        client: SSBClient
+            None uses the default client, see get_client()
+
+        offline: bool
+            Search the tables of the catalog (see set_catalog) instead of
+            all of Statistics Norway, in their ids, titles, variable names
+            and value texts, without any request. Case and æ/ø/å are
+            ignored: "kjonn" finds "Kjønn". The catalog must hold the
+            tables in the language searched in.
 
         """
+    client = client or get_client()
+    if offline:
+        return _search_catalog(phrase, language or client.language)
+
+    search_str = client.search_url(phrase, language, base_url)
 
-    # todo: make converter part of the default specification only for statistics norway
-    convert = {'æ': '%C3%A6', 'Æ': '%C3%86', 'ø': '%C3%B8', 'Ø': '%C3%98',
-               'å': '%C3%A5', 'Å': '%C3%85',
-               '"': '%22', '(': '%28', ')': '%29', ' ': '%20'}
+    df = pd.read_json(io.BytesIO(client.fetch('GET', search_str, language=language)))
+    return _format_search(df)
 
-    search_str = '{base_url}/{language}/table/?query={phrase}'.format(
-        base_url=base_url,
-        language=language,
-        phrase=phrase)
 
-    for k, v in convert.items():
-        search_str = search_str.replace(k, v)
+def _search_catalog(phrase, language):
+    # Searches the catalog with its SearchIndex, giving the columns of _format_search
+    if _CATALOG is None:
+        raise ValueError("An offline search needs a catalog, see set_catalog")
 
-    # print(search_str)
+    results = search_index(_CATALOG).search(phrase, language)
+    entries = _CATALOG.tables.get(language, {})
+    df = pd.DataFrame({'table_id': [table_id for table_id, _ in results],
+                       'table_title': [entries[table_id]['title'] for table_id, _ in results],
+                       'score': [score for _, score in results],
+                       'published': [entries[table_id].get('updated') for table_id, _ in results]})
+    if len(df) == 0:
+        logger.info("No match")
+    return df.set_index('table_id')
 
-    df = pd.read_json(search_str)
 
+def _format_search(df):
+    # Makes the results of a search more readable
     if len(df) == 0:
-        print("No match")
+        logger.info("No match")
         return df
 
     # make the dataframe more readable
@@ -175,444 +536,963 @@ def search(phrase,
     return df
 
 
-#Tables 07161 - 10794 concern national tests
-def get_frame_from_07161():
-    #Variabler - se her for å definere datasett nedenfor
-
-    # Reading the whole dataset
-    df = read_all("07161")
-
-    # Fixing column names
-    df.columns = ["region", "grade", "test", "level", "sex", "education", "students", "year", "percent"]
-
-    # Deleting 'contents' because it's a superfluous field
-    del df["students"]
-
-    #Changing the 5nd, 8nd, 9nd grade, to the more appropriate 5th, 8th, 9th-grade
-    df.grade = df.grade.str.replace('nd', 'th')
-    df.sex = df.sex.str.replace("Females", "Girls").str.replace("Males", "Boys")
-
-    return df
-def get_frame_from_07167():
-    #Variabler - se her for å definere datasett nedenfor
-
-    # Reading the whole dataset
-    df = read_all("07167")
+def _read_table(table_id, query=None):
+    # The whole table, or only the part selected by the query
+    if query is None:
+        return read_all(table_id)
+    return read_with_json(table_id, query)
+
+
+# How each table is cleaned up after it is downloaded:
+#   columns:  names of the columns, in the order they come from Statistics Norway
+#   drop:     superfluous columns that are deleted
+#   replace:  string fixes per column, as (old, new) pairs
+#   measures: for tables that have several measures in the same 'value'
+#             column, the label in 'contents' of each measure and its column
+#
+# Adding a table is a matter of adding its spec here.
+
+_GRADE_FIX = [('nd', 'th')]  # 5nd, 8nd, 9nd grade -> 5th, 8th, 9th grade
+
+TABLE_SPECS = {
+    #Tables 07161 - 10794 concern national tests
+    "07161": {'columns': ["region", "grade", "test", "level", "sex", "education", "students", "year", "percent"],
+              'drop': ["students"],
+              'replace': {'grade': _GRADE_FIX,
+                          'sex': [("Females", "Girls"), ("Males", "Boys")]}},
+    "07167": {'columns': ["test", "level", "pupils", "contents", "year", "percent"],
+              'drop': ["contents"]},
+    "07168": {'columns': ["grade", "test", "level", "centrality", "education", "contents", "year", "percent"],
+              'drop': ["contents"],
+              'replace': {'grade': _GRADE_FIX}},
+    "07170": {'columns': ["grade", "test", "level", "background", "education", "contents", "year", "percent"],
+              'drop': ["contents"],
+              'replace': {'grade': _GRADE_FIX}},
+    "08558": {'columns': ["region", "test_8th", "level_8th", "test_5th", "level_5th", "education", "contents",
+                          "year", "percent"],
+              'drop': ["contents"]},
+    "09818": {'columns': ["grade", "test", "level", "immigrant", "education", "contents", "year", "percent"],
+              'drop': ["contents"],
+              'replace': {'grade': _GRADE_FIX}},
+    "10793": {'columns': ["grade", "test", "background", "sex", "contents", "year", "value"],
+              'replace': {'grade': _GRADE_FIX},
+              'measures': {'Score points': 'score', 'Pupils (persons)': 'pupils'}},
+    "10794": {'columns': ["region", "grade", "test", "sex", "education", "contents", "year", "value"],
+              'replace': {'grade': _GRADE_FIX},
+              'measures': {'Score points': 'score', 'Pupils (persons)': 'pupils'}},
+
+    #Tables 07495 - 11690 concern pupil grades
+    "07495": {'columns': ["region", "sex", "education", "contents", "year", "value"],
+              'measures': {'Average lower secondary school points': 'points', 'Pupils': 'pupils'}},
+    "07496": {'columns': ["region", "subject", "sex", "education", "contents", "year", "value"],
+              'measures': {'Average overall achievement mark': 'points', 'Pupils': 'pupils'}},
+    "07497": {'columns': ["background", "sex", "contents", "year", "value"],
+              'measures': {'Average lower secondary school points': 'points', 'Pupils': 'pupils'}},
+    "07498": {'columns': ["subject", "sex", "education", "contents", "year", "value"],
+              'measures': {'Average examination mark': 'marks', 'Pupils': 'pupils'}},
+    "07499": {'columns': ["subject", "background", "sex", "contents", "year", "value"],
+              'measures': {'Average overall achievement mark': 'marks', 'Pupils': 'pupils'}},
+    "07500": {'columns': ["subject", "background", "sex", "contents", "year", "value"],
+              'measures': {'Average examination mark': 'marks', 'Pupils': 'pupils'}},
+    "07501": {'columns': ["subject", "ownership", "education", "contents", "year", "value"],
+              'measures': {'Average mark': 'marks', 'Pupils': 'pupils'}},
+    "07502": {'columns': ["marks", "subject", "sex", "education", "contents", "year", "value"],
+              'measures': {'Pupils (per cent)': 'percent', 'Pupils': 'pupils'}},
+    "08533": {'columns': ["marks", "subject", "test", "education", "contents", "year", "percent"],
+              'drop': ["contents"]},
+    "11688": {'columns': ["region", "sex", "points", "contents", "year", "value"],
+              'measures': {'Pupils (per cent)': 'percent', 'Pupils': 'pupils'}},
+    "11689": {'columns': ["sex", "points", "education", "contents", "year", "value"],
+              'measures': {'Pupils (per cent)': 'percent', 'Pupils': 'pupils'}},
+    "11690": {'columns': ["sex", "background", "points", "contents", "year", "value"],
+              'measures': {'Pupils (per cent)': 'percent', 'Pupils': 'pupils'}},
+}
+
+
+def apply_spec(df, spec):
+    """
+        Cleans up a table as downloaded by read_all according to its spec in
+        TABLE_SPECS: names the columns, applies the string fixes, deletes the
+        superfluous columns and turns the measures in the 'value' column into
+        columns of their own.
+        """
+    df = df.set_axis(spec['columns'], axis=1)
+    df = df.drop(columns=spec.get('drop', []))
+    replace = spec.get('replace', {})
+    measures = spec.get('measures')
+
+    if not measures:
+        for column in replace:
+            df[column] = _replace_labels(df[column], replace[column])
+        return df
 
-    #Fixing column names
-    df.columns = ["test", "level", "pupils", "contents", "year", "percent"]
+    # One row per combination of the dimensions, with a column per measure
+    dims = [column for column in df.columns if column not in ('contents', 'value')]
+
+    contents_codes, contents = pd.factorize(df['contents'])
+    position = {label: i for i, label in enumerate(measures)}
+    measure = np.array([position.get(label, -1) for label in contents], dtype=np.intp)
+    measure = measure[contents_codes] if len(contents) else contents_codes
+
+    rows = [np.flatnonzero(measure == i) for i in range(len(measures))]
+    values = df['value'].to_numpy(dtype=float, na_value=np.nan)
+
+    if _aligned(df[dims], rows):
+        # The usual case: every measure has its rows in the same order, as
+        # in a json-stat response, so the rows of the first one are the keys
+        wide = df[dims].take(rows[0]).reset_index(drop=True)
+        for column, measure_rows in zip(measures.values(), rows):
+            wide[column] = values[measure_rows]
+    else:
+        wide = _pivot_measures(df[dims], measure, values, list(measures.values()))
+
+    for column in replace:
+        wide[column] = _replace_labels(wide[column], replace[column])
+
+    return wide
+
+
+def _aligned(dims, rows):
+    # Whether the dimensions of the rows of each measure are the same, row for row
+    if any(len(measure_rows) != len(rows[0]) for measure_rows in rows):
+        return False
+    first = dims.take(rows[0]).reset_index(drop=True)
+    return all(first.equals(dims.take(measure_rows).reset_index(drop=True))
+               for measure_rows in rows[1:])
+
+
+def _pivot_measures(dims, measure, values, names):
+    # Pivots the measures into columns when their rows are in any order:
+    # each row's combination of dimensions is numbered in order of first
+    # appearance, and its value is put in that combination's row
+    keep = measure >= 0
+    codes, labels = [], []
+    for column in dims.columns:
+        column_codes, uniques = pd.factorize(dims[column], use_na_sentinel=False)
+        codes.append(column_codes[keep])
+        labels.append(uniques)
+
+    sizes = [max(len(uniques), 1) for uniques in labels]
+    groups, combinations = pd.factorize(np.ravel_multi_index(codes, sizes))
+
+    # the first row of each combination; of repeated writes the last one wins
+    first = np.empty(len(combinations), dtype=np.intp)
+    first[groups[::-1]] = np.arange(len(groups) - 1, -1, -1)
+
+    pivoted = np.full((len(combinations), len(names)), np.nan)
+    pivoted[groups, measure[keep]] = values[keep]
+
+    wide = pd.DataFrame({column: uniques.take(column_codes[first])
+                         for column, column_codes, uniques in zip(dims.columns, codes, labels)})
+    for i, name in enumerate(names):
+        wide[name] = pivoted[:, i]
+    return wide
+
+
+def _replace_labels(series, fixes):
+    # Applies the string fixes once per distinct label rather than once per row
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        for old, new in fixes:
+            categories = categories.str.replace(old, new, regex=False)
+        if categories.is_unique:
+            return series.cat.rename_categories(categories)
+        series = series.astype(object)
+
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    for old, new in fixes:
+        uniques = uniques.str.replace(old, new, regex=False)
+    return pd.Series(uniques.take(codes), index=series.index, name=series.name)
+
+
+def get_frame(table_id, query=None, **selections):
+    """
+        Downloads a table, or the part of it selected by the query or the
+        selections, and cleans it up as described in TABLE_SPECS.
 
-    #Deleting 'contents' because it's a superfluous field
-    del df["contents"]
+        Example
+        -------
 
-    return df
-def get_frame_from_07168():
-    #Variabler - se her for å definere datasett nedenfor
+            df = get_frame("07161", region=["Oslo"], year=slice(2015, None))
 
 
-    #Reading the whole dataset
-    df = read_all("07168")
+        Parameters
+        ----------
 
-    #Fixing column-names
-    df.columns = ["grade", "test", "level", "centrality", "education", "contents", "year", "percent"]
+        selections:
+            Selections on the columns of the cleaned-up table, by their
+            names in TABLE_SPECS, see spec_selections. They are sent to
+            Statistics Norway, so only the selected rows are downloaded.
+        """
+    if selections:
+        if query is not None:
+            raise ValueError("Give either a query or selections, not both")
+        variables = get_variables(table_id)
+        query = build_query(variables, spec_selections(table_id, variables, selections))
 
-    #Deleting 'contents' because it's a superfluous field
-    del df["contents"]
+    df = _read_table(table_id, query)
+    with metrics.stage('reshape'):
+        return apply_spec(df, TABLE_SPECS[table_id])
 
-    # Changing the 5nd, 8nd, 9nd grade, to the more appropriate 5th, 8th, 9th-grade
-    df.grade = df.grade.str.replace('nd', 'th')
 
-    return df
-def get_frame_from_07170():
+def spec_selections(table_id, variables, selections):
+    """
+        Translates selections on the columns of a cleaned-up table into
+        selections on the table's variables, for build_query.
+
+        A selection is a value, a list of values, or a slice of values with
+        both ends included. Values may be given as codes, as Statistics
+        Norway labels them, or as they are labelled after the string fixes
+        of the spec ("8th grade", "Girls"). Slices compare codes and labels
+        as strings, so year=slice(2015, None) selects 2015 onwards.
+        """
+    spec = TABLE_SPECS[table_id]
+    columns = spec['columns'][:len(variables)]
+    replace = spec.get('replace', {})
+
+    translated = {}
+    for name, wanted in selections.items():
+        if name not in columns:
+            raise ValueError(f"Table {table_id} has no dimension {name!r}, expected one of {columns}")
+        variable = variables[columns.index(name)]
+
+        codes = list(variable['values'])
+        texts = list(variable.get('valueTexts', codes))
+        fixed = list(texts)
+        for old, new in replace.get(name, []):
+            fixed = [text.replace(old, new) for text in fixed]
+
+        if isinstance(wanted, slice):
+            start = None if wanted.start is None else str(wanted.start)
+            stop = None if wanted.stop is None else str(wanted.stop)
+            translated[variable['code']] = [
+                code for code, text in zip(codes, fixed)
+                if any((start is None or start <= label) and (stop is None or label <= stop)
+                       for label in (code, text))]
+            continue
+
+        if isinstance(wanted, (str, int, float)):
+            wanted = [wanted]
+
+        lookup = {}
+        for code, text, fixed_text in zip(codes, texts, fixed):
+            lookup.setdefault(fixed_text, code)
+            lookup.setdefault(text, code)
+            lookup[code] = code
+
+        values = []
+        for value in wanted:
+            if str(value) not in lookup:
+                raise ValueError(f"{value!r} is not a value of {name} in table {table_id}")
+            values.append(lookup[str(value)])
+        translated[variable['code']] = values
+
+    return translated
+
+
+TABLE_DICT = {table_id: partial(get_frame, table_id) for table_id in TABLE_SPECS}
+
+
+# File extensions of the export formats of create_all_tables
+EXPORT_FORMATS = {'csv': 'csv', 'parquet': 'parquet', 'feather': 'feather'}
+
+
+def create_all_tables(folder="tables/",
+                      max_workers=1,
+                      max_per_host=None,
+                      requests_per_second=None,
+                      format='csv',
+                      storage=None,
+                      force=False):
+    """
+        Downloads every table in TABLE_DICT and writes it to
+        {folder}table_{table}.{format}, followed by the title file, or
+        to another storage.
+
+        The metadata of every table is fetched again first, also when a
+        catalog is set, so that the queries ask for newly published
+        periods. The hash of each download is kept in the storage's
+        manifest, with the date Statistics Norway last published the
+        table. Tables whose download has the same hash as last time are
+        not decoded or written again, nor is an unchanged title file, so
+        that the files of unchanged tables keep their modification times.
+        Returns the ids of the tables that were written.
 
-    df = read_all("07170")
+        Parameters
+        ----------
 
-    columns = ["grade", "test", "level", "background", "education", "contents", "year", "percent"]
-    df.columns = columns
+        folder: string
+            Folder the files are written to.
 
-    #Deleting 'contents' because it's a superfluous field
-    del df["contents"]
+        format: string
+            'csv' writes every column as text.
+            'parquet' and 'feather' (Arrow IPC) keep the types: dimensions
+            are stored as categoricals, measures as floats or nullable
+            integers, and the table title is kept in the file metadata.
+            Read them back with read_table. Needs pyarrow.
 
-    # Changing the 5nd, 8nd, 9nd grade, to the more appropriate 5th, 8th, 9th-grade
-    df.grade = df.grade.str.replace('nd', 'th')
+        max_workers: int
+            Number of tables downloaded concurrently. Each table is
+            written as soon as it has finished downloading.
 
-    return df
-def get_frame_from_08558():
+        max_per_host: int or None
+            Maximum number of requests in flight against data.ssb.no while
+            the tables are created. None keeps the limit of the client.
 
-    #Reading the whole dataset
-    df = read_all("08558")
+        requests_per_second: float or None
+            Maximum number of requests started per second while the tables
+            are created. None keeps the limit of the client.
 
-    #Fixing column-names
-    df.columns = ["region", "test_8th", "level_8th", "test_5th", "level_5th", "education", "contents",
-               "year", "percent"]
+        storage: Storage or None
+            Where the tables go: a DirectoryStorage, SQLiteStorage or
+            DuckDBStorage. None writes to folder in the format. Every table
+            is replaced atomically, so readers never see half of one.
 
-    #Deleting 'contents' because it's a superfluous field
-    del df["contents"]
+        force: bool
+            Write every table, changed or not.
+        """
+    # the limits only hold for this call, the client keeps its own
+    client = get_client()
+    limiter = client.limiter
+    if max_per_host is not None or requests_per_second is not None:
+        client.limiter = RateLimiter(limiter.max_per_host if max_per_host is None else max_per_host,
+                                     limiter.requests_per_second if requests_per_second is None
+                                     else requests_per_second)
+    try:
+        return _create_all_tables(folder, max_workers, format, storage, force)
+    finally:
+        client.limiter = limiter
+
+
+def _create_all_tables(folder, max_workers, format, storage, force):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    storage = storage or DirectoryStorage(folder, format)
+    catalog = _CATALOG or Catalog()
+    titles = get_table_titles(refresh=True, catalog=catalog)
+    title_of = dict(titles.values)
+
+    old_manifest = {} if force else storage.read_manifest()
+    manifest = dict(old_manifest)
+    changed = []
+
+    def create_table(table):
+        start = time.perf_counter()
+        with metrics.table_context(table):
+            bodies, chunks, query = _download_bodies(table, catalog.variables(table))
+            digest = _content_hash(bodies)
+            entry = {'hash': digest, 'updated': catalog.entry(table).get('updated')}
+
+            if old_manifest.get(table, {}).get('hash') == digest and storage.exists(table):
+                logger.info("Table %s is unchanged, skipped", table, extra={'ssb_table': table})
+                manifest[table] = entry
+                return
+
+            df, seconds = _decode_table(bodies, chunks, query, TABLE_SPECS[table],
+                                        sort_columns(table), storage.compact)
+            metrics.timing('decode', seconds)
+            metrics.count('rows', len(df))
+            with metrics.stage('write'):
+                storage.write(table, df, title=title_of[table])
+            manifest[table] = entry
+            changed.append(table)
+        logger.info("Downloaded and created table_%s", table,
+                    extra={'ssb_table': table, 'ssb_rows': len(df), 'ssb_seconds': time.perf_counter() - start})
+
+    # the manifest is saved even if a table fails, so the others are not written again
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(create_table, table) for table in get_table_codes()]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        titles_hash = _content_hash([titles.to_csv(index=False).encode('utf-8')])
+        if old_manifest.get('titles', {}).get('hash') != titles_hash:
+            storage.write_titles(titles)
+            logger.info("Finished creating title file")
+        manifest['titles'] = {'hash': titles_hash, 'updated': None}
+        storage.write_manifest(manifest)
+
+    logger.info("Finished creating tables, %d changed", len(changed), extra={'ssb_changed': changed})
+    return sorted(changed)
+
+
+def _content_hash(bodies):
+    digest = hashlib.sha256()
+    for body in bodies:
+        digest.update(body)
+    return digest.hexdigest()
 
-    return df
-def get_frame_from_09818():
-    #Variabler - se her for å definere datasett nedenfor
 
-    # Reading the whole dataset-
-    df = read_all("09818")
+def create_title_file(folder="tables/"):
+    DirectoryStorage(folder).write_titles(get_table_titles())
+    logger.info("Finished creating title file")
 
-    # Fixing column names
-    df.columns = ["grade", "test", "level", "immigrant", "education", "contents", "year", "percent"]
 
-    #Deleting 'contents' because it's a superfluous field
-    del df["contents"]
+# The measures that count something. They are whole numbers and kept as
+# integers; every other measure (per cent, points, marks) is a float.
+COUNT_MEASURES = ('pupils',)
 
-    # Changing the 5nd, 8nd, 9nd grade, to the more appropriate 5th, 8th, 9th-grade
-    df.grade = df.grade.str.replace('nd', 'th')
 
+def export_dtypes(df):
+    """
+        Returns a copy of a table from get_table with the dimensions as
+        categoricals, the counts (COUNT_MEASURES) as nullable integers and
+        the other measures as float64.
+        """
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if not pd.api.types.is_numeric_dtype(values):
+            df[column] = values.astype('category')
+        elif column in COUNT_MEASURES:
+            # nullable integers from compact_dtypes keep their width
+            if not pd.api.types.is_integer_dtype(values):
+                df[column] = values.astype('Int64')
+        else:
+            df[column] = _float64(values)
     return df
-def get_frame_from_10793():
-    #Variables - how to define a data-set.
-
-    #Reading all data
-    df = read_all("10793")
-
-    #Fixing column names
-    df.columns = ["grade", "test", 'background', "sex", "contents", "year", "value"]
-
-    #Fixing typos in dataset
-    df.grade = df.grade.str.replace("nd", "th")
 
-    #Restructuring
-    #The reason this is done is because the values for score and number of pupils
-    #is inexplicably in the same column.
-    df_score = df.rename(columns={'value': 'score'})
-    df_score = df_score[df_score.contents == 'Score points']
-    df_score.reset_index(drop=True, inplace=True)
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils (persons)']
-    df_pupils.reset_index(drop=True, inplace=True)
+def _float64(values):
+    # float32 measures from compact_dtypes as float64, the decimal they came
+    # from: 47.9 and not 47.900001525878906. That is the value rounded to the
+    # seven significant digits float32 holds, or where that does not give the
+    # same float32 back, its shortest decimal text.
+    if not (pd.api.types.is_float_dtype(values) and values.dtype.itemsize < 8):
+        return values.astype('float64')
 
-    return pd.concat([df_score, df_pupils.pupils], axis=1).drop(columns=['contents'])
-    #Variables - how to define a data-set.
+    array = values.to_numpy(dtype=np.float32, na_value=np.nan)
+    wide = array.astype(np.float64)
+    finite = np.isfinite(wide) & (wide != 0)
+    digits = np.zeros(len(wide), dtype=np.int64)
+    digits[finite] = 6 - np.floor(np.log10(np.abs(wide[finite]))).astype(np.int64)
 
+    # powers of ten above one are exact, so scale up with them on both sides
+    up = digits >= 0
+    scale = 10.0 ** np.abs(digits)
+    rounded = np.where(up, np.round(wide * scale) / scale, np.round(wide / scale) * scale)
+    rounded = np.where(finite, rounded, wide)
 
-    #Reading all data
-    df = read_all("10793")
+    off = rounded.astype(np.float32) != array
+    off &= ~np.isnan(array)
+    if off.any():
+        rounded[off] = array[off].astype(str).astype(np.float64)
+    return pd.Series(rounded, index=values.index, name=values.name)
 
-    #Fixing column names
-    df.columns = ["grade", "test", 'background', "sex", "contents", "year", "value"]
 
-    #Fixing typos in dataset
-    df.grade = df.grade.str.replace("nd", "th")
-
-    #Restructuring
-    #The reason this is done is because the values for score and number of pupils
-    #is inexplicably in the same column.
-    df_score = df.rename(columns={'value': 'score'})
-    df_score = df_score[df_score.contents == 'Score points']
-    df_score.reset_index(drop=True, inplace=True)
-
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils (persons)']
-    df_pupils.reset_index(drop=True, inplace=True)
-
-    return pd.concat([df_score, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_10794():
-    #Variables - how to define a data-set.
+def compact_dtypes(df):
+    """
+        Returns a table from get_table with smaller dtypes: dimensions as
+        categoricals, counts (COUNT_MEASURES) as nullable Int32 and the
+        other measures as float32. The dtype of a measure follows from its
+        column, so it is the same for every selection of the table.
+
+        float32 holds about seven significant digits. The measures of these
+        tables have one or two decimals, so the shortest decimal text of
+        each value is the same as before (str gives '47.9'), but the value
+        itself is not: float32(47.9) != 47.9 once it is compared with a
+        float64. write_table and the database storages store them as
+        float64 again.
+        """
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if not pd.api.types.is_numeric_dtype(values):
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                columns[column] = values.astype('category')
+        elif column in COUNT_MEASURES:
+            if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 != 0).any():
+                raise ValueError(f"The count {column!r} has values that are not whole numbers")
+            columns[column] = values.astype('Int32')
+        else:
+            columns[column] = values.astype(np.float32)
+
+    return df.assign(**columns) if columns else df
+
+
+def write_table(df, path, format='parquet', table_id=None, title=None):
+    """
+        Writes a table to a parquet or feather (Arrow IPC) file with the
+        dtypes of export_dtypes (measures as float64, counts as integers),
+        keeping the table id and title in the file metadata. Feather files
+        are written uncompressed, so that read_table can memory-map them.
+        """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(export_dtypes(df), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'ssb_table_id'] = str(table_id or '').encode('utf-8')
+    metadata[b'ssb_title'] = str(title or '').encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        # smallish row groups, so that their statistics let queries skip most of them
+        pq.write_table(table, path, row_group_size=64 * 1024)
+    elif format == 'feather':
+        import pyarrow.feather as feather
+        feather.write_feather(table, path, compression='uncompressed')
+    else:
+        raise ValueError(f"Unknown format {format!r}, expected 'parquet' or 'feather'")
+
+
+def read_table(table_id, folder="tables/", format='parquet', columns=None):
+    """
+        Reads a table written by create_all_tables with format='parquet' or
+        'feather', memory-mapping the file. The table id and title are put
+        in df.attrs.
 
-    df = read_all("10794")
-    df.grade = df.grade.str.replace("nd", "th")
-    df.columns = ["region", "grade", "test", "sex", "education", "contents", "year", "value"]
+        Example
+        -------
 
-    df_score = df.rename(columns={'value': 'score'})
-    df_score = df_score[df_score.contents == 'Score points']
-    df_score.reset_index(drop=True, inplace=True)
+            df = read_table("07161", "tables/", format='feather')
+            df.attrs['title']
+        """
+    import pyarrow as pa
+
+    path = os.path.join(folder, f"table_{table_id}.{EXPORT_FORMATS[format]}")
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    elif format == 'feather':
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    else:
+        raise ValueError(f"Unknown format {format!r}, expected 'parquet' or 'feather'")
+
+    metadata = table.schema.metadata or {}
+    df = table.to_pandas()
+    df.attrs['table_id'] = metadata.get(b'ssb_table_id', b'').decode('utf-8')
+    df.attrs['title'] = metadata.get(b'ssb_title', b'').decode('utf-8')
+    return df
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils (persons)']
-    df_pupils.reset_index(drop=True, inplace=True)
 
-    return pd.concat([df_score, df_pupils.pupils], axis=1).drop(columns=['contents'])
+def query(table_id, filters=None, columns=None, folder="tables/", format='parquet', index=None):
+    """
+        Looks up rows of a table stored by create_all_tables with
+        format='parquet' or 'feather', without downloading anything.
 
-#Tables 07495 - 11690 concern pupil grades
-def get_frame_from_07495():
-    #Marks, lower secondary school
-    #07495: Lower secondary school points, by sex and parents' educational attainment level (C) 2009 - 2018
+        Example
+        -------
 
-    #Reading all data
-    df = read_all("07495")
-    print("running local folder")
-    #Fixing column names
-    df.columns = ["region", "sex", 'education', "contents", "year", "value"]
+            df = query("07161", {"region": "Oslo", "grade": "8th grade", "year": "2017"},
+                       columns=["level", "percent"])
+            df = query("07161", {"year": slice(2015, None)})
 
-    #Restructuring - because points and number of students are in the same column
 
-    df_points = df.rename(columns={'value': 'points'})
-    df_points = df_points[df_points.contents == 'Average lower secondary school points']
-    df_points.reset_index(drop=True, inplace=True)
+        Parameters
+        ----------
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
+        filters: dict
+            Maps columns to a value, a list of values, or a slice of values
+            (both ends included). All filters must be met.
 
+        columns: list
+            The columns to return. None returns all of them.
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07496():
-    #Marks, lower secondary school
-    #07496: Overall achievement marks, by subject, sex and parents' educational attainment level (C) 2009 - 2018
+        index: bool or None
+            True keeps the table open in this process with an index on the
+            dimension columns, which makes repeated point lookups cheap.
+            Feather files are memory-mapped, but parquet files are decoded
+            into memory whole. False pushes the filters down to the file
+            instead, reading only the row groups that can match. None, the
+            default, indexes feather files and scans parquet files.
+        """
+    path = os.path.join(folder, f"table_{table_id}.{EXPORT_FORMATS[format]}")
+    if index is None:
+        index = format == 'feather'
+    if index:
+        return open_table(path).query(filters, columns)
+    return scan_table(path, filters, columns)
 
-    #Reading all data
-    df = read_all("07496")
-    print("running local folder")
-    #Fixing column names
-    df.columns = ["region", "subject", 'sex', "education", "contents", "year", "value"]
 
-    #Restructuring - because points and number of students are in the same column
+# Where publish_tables puts the tables by default: in memory, where there is a /dev/shm
+SHARED_FOLDER = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'ssb_tables')
 
-    df_points = df.rename(columns={'value': 'points'})
-    df_points = df_points[df_points.contents == 'Average overall achievement mark']
-    df_points.reset_index(drop=True, inplace=True)
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
+def publish_tables(folder=SHARED_FOLDER, max_workers=1, force=False):
+    """
+        Downloads every table in TABLE_DICT once and writes it as an
+        uncompressed Arrow IPC (feather) file that any number of processes
+        can attach to with attach_table, sharing the same memory. Tables
+        that have not changed since they were last published are left as
+        they are, see create_all_tables, whose ids of changed tables it
+        returns.
 
+        Example
+        -------
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07497():
-    #Marks, lower secondary school
-    #07497: Lower secondary school marks, by immigration category and sex 2009 - 2018
+            # once, e.g. in the gunicorn master or a cron job
+            publish_tables()
 
-    #Reading all data
-    df = read_all("07497")
-    #Fixing column names
-    df.columns = ["background", "sex", 'contents', "year", "value"]
+            # in every worker
+            df = attach_table("07161")
+        """
+    return create_all_tables(max_workers=max_workers, force=force,
+                             storage=DirectoryStorage(folder, 'feather'))
 
-    #Restructuring - because points and number of students are in the same column
 
-    df_points = df.rename(columns={'value': 'points'})
-    df_points = df_points[df_points.contents == 'Average lower secondary school points']
-    df_points.reset_index(drop=True, inplace=True)
+def attach_table(table_id, folder=SHARED_FOLDER, columns=None):
+    """
+        Returns a table published with publish_tables as a read-only
+        DataFrame backed by the memory-mapped file: the pages are shared
+        by every process that attaches to it, so memory stays flat as
+        workers are added, and attaching takes milliseconds. Dimensions
+        stay dictionary-encoded. Use .copy() or read_table for a frame of
+        one's own, and query for point lookups.
+        """
+    return open_table(os.path.join(folder, f"table_{table_id}.feather")).to_pandas(columns)
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
 
+def get_table(table, query=None, sort=True, by=None, compact=True, **selections):
+    """
+        Downloads a table, cleans it up and sorts its rows. See get_frame
+        for the query and selections.
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07498():
-    #Marks, lower secondary school
-    #07498: Examination marks, by subject, sex and parents' educational attainment level 2009 - 2018
+        Parameters
+        ----------
 
-    #Reading all data
-    df = read_all("07498")
-    #Fixing column names
-    df.columns = ["subject", "sex", 'education', "contents", "year", "value"]
+        sort: bool
+            Whether to sort the rows. Rows are kept whole: the measures
+            stay with their dimensions.
 
-    #Restructuring - because points and number of students are in the same column
+        by: list
+            The columns to sort on, in order. Defaults to the dimension
+            columns followed by year, see dimension_columns.
 
-    df_points = df.rename(columns={'value': 'marks'})
-    df_points = df_points[df_points.contents == 'Average examination mark']
-    df_points.reset_index(drop=True, inplace=True)
+        compact: bool
+            Whether to shrink the counts to nullable Int32 and the other
+            measures to float32, see compact_dtypes. The dimensions are
+            categoricals either way.
+        """
+    key = ['get_table', table, query, selections, sort, by, compact, get_client().language]
+    with metrics.table_context(table):
+        return _coalesce(key, lambda: _get_table(table, query, sort, by, compact, selections))
+
+
+def _get_table(table, query, sort, by, compact, selections):
+    df = TABLE_DICT[table](query, **selections)
+    if compact:
+        with metrics.stage('reshape'):
+            df = compact_dtypes(df)
+    if sort:
+        with metrics.stage('sort'):
+            df = sort_table(df, by or sort_columns(table))
+    metrics.count('rows', len(df))
+    return df
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
 
+def get_tables(table_ids, max_workers=4, processes=0, on_error='raise', lazy=False,
+               sort=True, compact=True):
+    """
+        Downloads several tables at once and returns them cleaned up and
+        sorted like get_table, in a dict keyed by table id.
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07499():
-    #Marks, lower secondary school
-    #07499: Overall achievement marks, by subject, immigration category and sex 2009 - 2018
+        The downloads run in threads that share the client's session, and
+        the metadata of all tables is fetched in one pass into the catalog
+        (see set_catalog; a temporary one is used when none is set). Each
+        table is decoded and cleaned up as soon as its download is done,
+        in its download thread or in a process pool.
 
-    #Reading all data
-    df = read_all("07499")
-    #Fixing column names
-    df.columns = ["subject", "background", 'sex', "contents", "year", "value"]
+        Example
+        -------
 
-    #Restructuring - because points and number of students are in the same column
+            tests = get_tables(["07161", "07167", "07168", "07170"])
+            tests["07161"].head()
 
-    df_marks = df.rename(columns={'value': 'marks'})
-    df_marks = df_marks[df_marks.contents == 'Average overall achievement mark']
-    df_marks.reset_index(drop=True, inplace=True)
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
+        Parameters
+        ----------
 
+        max_workers: int
+            Number of tables downloaded concurrently.
+
+        processes: int or None
+            Size of a process pool that decodes the tables, None for one
+            process per cpu. 0 decodes in the download threads. The pool
+            is started for the call, and its processes import pandas
+            first, so it only pays off for large tables on several cpus.
+            Its processes import the calling script, which must then
+            guard its own code with if __name__ == '__main__'.
+
+        on_error: string
+            'raise' raises the first error, 'skip' leaves the table out and
+            logs a warning, 'return' puts the exception in its place.
+
+        lazy: bool
+            Return at once a mapping whose values are waited for when they
+            are looked up, while the downloads go on in the background.
+            Call close() on it, or use it in a with block, to shut the
+            pools down.
+        """
+    if on_error not in ('raise', 'skip', 'return'):
+        raise ValueError(f"Unknown on_error {on_error!r}, expected 'raise', 'skip' or 'return'")
 
-    return pd.concat([df_marks, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07500():
-    #Marks, lower secondary school
-    #07500: Examination marks, by subject, immigration category and sex 2009 - 2018
+    table_ids = list(dict.fromkeys(table_ids))
+    catalog = _CATALOG or Catalog()
+    try:
+        catalog.refresh(catalog.stale(table_ids))
+    except Exception:
+        # left to the downloads, so that the error is put on its table
+        pass
 
-    #Reading all data
-    df = read_all("07500")
-    #Fixing column names
-    df.columns = ["subject", "background", 'sex', "contents", "year", "value"]
+    tables = TableBatch(table_ids, catalog, max_workers, processes, on_error, sort, compact)
+    if lazy:
+        return tables
+    with tables:
+        return tables.to_dict()
 
-    #Restructuring - because points and number of students are in the same column
 
-    df_points = df.rename(columns={'value': 'marks'})
-    df_points = df_points[df_points.contents == 'Average examination mark']
-    df_points.reset_index(drop=True, inplace=True)
+class TableBatch(Mapping):
+    """
+        The tables of get_tables, downloaded in the background. Looking a
+        table up waits for it.
+        """
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
+    def __init__(self, table_ids, catalog, max_workers, processes, on_error, sort, compact):
+        from concurrent.futures import Future, ThreadPoolExecutor
+
+        self.on_error = on_error
+        self._threads = ThreadPoolExecutor(max_workers=max_workers)
+        self._processes = None
+        if processes != 0:
+            # forkserver, as forking a process with threads running is unsafe
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            context = multiprocessing.get_context('forkserver' if os.name == 'posix' else 'spawn')
+            self._processes = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+        self._futures = {}
+        for table_id in table_ids:
+            future = self._futures[table_id] = Future()
+            self._threads.submit(self._download, table_id, catalog, sort, compact, future)
+
+    def _download(self, table_id, catalog, sort, compact, future):
+        with metrics.table_context(table_id):
+            try:
+                bodies, chunks, query = _download_bodies(table_id, catalog.variables(table_id))
+                args = (bodies, chunks, query, TABLE_SPECS[table_id],
+                        sort_columns(table_id) if sort else None, compact)
+                if self._processes is None:
+                    self._finish(table_id, future, _decode_table(*args))
+                else:
+                    decoding = self._processes.submit(_decode_table, *args)
+                    decoding.add_done_callback(lambda done: self._finish(table_id, future, done))
+            except Exception as error:
+                future.set_exception(error)
+
+    def _finish(self, table_id, future, done):
+        # Passes on the result of a decode, recording how long it took
+        from concurrent.futures import Future
+
+        try:
+            df, seconds = done.result() if isinstance(done, Future) else done
+        except Exception as error:
+            future.set_exception(error)
+            return
+        with metrics.table_context(table_id):
+            metrics.timing('decode', seconds)
+            metrics.count('rows', len(df))
+        future.set_result(df)
+
+    def __getitem__(self, table_id):
+        future = self._futures[table_id]
+        error = future.exception()
+        if error is None:
+            return future.result()
+        if self.on_error == 'return':
+            return error
+        if self.on_error == 'skip':
+            raise KeyError(table_id)
+        raise error
+
+    def __iter__(self):
+        if self.on_error != 'skip':
+            return iter(self._futures)
+        return (table_id for table_id in self._futures if self._futures[table_id].exception() is None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        tables = {}
+        for table_id, future in self._futures.items():
+            error = future.exception()
+            if error is not None and self.on_error == 'skip':
+                logger.warning("Could not get table %s: %s", table_id, error, extra={'ssb_table': table_id})
+                continue
+            tables[table_id] = self[table_id]
+        return tables
+
+    def close(self):
+        self._threads.shutdown(wait=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _download_bodies(table_id, variables):
+    # The response bodies of the whole table, in chunks as split_query splits
+    # its query, without decoding them
+    client = get_client()
+    full_url = client.table_url(table_id)
+    query = build_query(variables)
+    chunks = split_query(query)
+    with metrics.stage('post'):
+        bodies = [client.fetch('POST', full_url, query=chunk) for chunk, _ in chunks]
+    return bodies, chunks, query
+
+
+def _decode_table(bodies, chunks, query, spec, by, compact):
+    # The CPU-bound part of get_table, from the response bodies to the
+    # cleaned-up table, and how long it took. Runs in a worker process.
+    start = time.perf_counter()
+    frames = [decode_json_stat(body) for body in bodies]
+    df = frames[0] if len(frames) == 1 else _assemble_chunks(frames, chunks, query, ordered=True)
+    df = apply_spec(df, spec)
+    if compact:
+        df = compact_dtypes(df)
+    if by:
+        df = sort_table(df, by)
+    return df, time.perf_counter() - start
+
+
+def sort_columns(table_id):
+    # The default sort order of get_table: the dimensions, then year
+    return [column for column in dimension_columns(table_id) if column != 'year'] + ['year']
+
+
+def dimension_columns(table_id):
+    """
+        Returns the dimension columns of a table after clean-up, that is
+        the columns that are not measures, in table order.
+        """
+    spec = TABLE_SPECS[table_id]
+    measures = spec.get('measures')
+    if measures:
+        not_dimensions = {'contents', 'value'}
+    else:
+        not_dimensions = {spec['columns'][-1]}
+    not_dimensions.update(spec.get('drop', []))
+    return [column for column in spec['columns'] if column not in not_dimensions]
 
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07501():
-    #Marks, lower secondary school
-    #07501: Examination and overall achievement marks, selected subjects, by ownership and parents' educational attainment level 2009 - 2018
+def sort_table(df, by):
+    """
+        Sorts the rows of a table on the columns in by, in one stable pass
+        over a single key combined from the codes of the columns.
+        Categorical columns sort in the order of their categories, others
+        by value, and missing values come last. A table that is already
+        sorted is returned as it is.
+        """
+    codes, sizes = [], []
+    for column in by:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            column_codes = values.cat.codes.to_numpy().astype(np.int64)
+            size = len(values.cat.categories)
+        else:
+            column_codes, uniques = pd.factorize(values, sort=True)
+            size = len(uniques)
+        codes.append(np.where(column_codes < 0, size, column_codes))
+        sizes.append(size + 1)
+
+    if not len(df) or not codes:
+        return df
 
-    #Reading all data
-    df = read_all("07501")
-    #Fixing column names
-    df.columns = ["subject", "ownership", 'education', "contents", "year", "value"]
+    if np.prod(np.array(sizes, dtype=float)) < 2 ** 62:
+        key = np.ravel_multi_index(codes, sizes)
+        if (key[1:] >= key[:-1]).all():
+            return df
+        order = np.argsort(key, kind='stable')
+    else:
+        order = np.lexsort(codes[::-1])
+        if (order == np.arange(len(order))).all():
+            return df
 
-    #Restructuring - because points and number of students are in the same column
+    return df.take(order).reset_index(drop=True)
 
-    df_points = df.rename(columns={'value': 'marks'})
-    df_points = df_points[df_points.contents == 'Average mark']
-    df_points.reset_index(drop=True, inplace=True)
-
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
 
+def refresh_table(table_id, store="tables/", storage=None):
+    """
+        Brings {store}table_{table_id}.csv, as written by create_all_tables,
+        or the table in another storage, up to date by downloading only the
+        time periods that are missing from it and appending their rows. The
+        whole table is downloaded if it is not stored yet.
+        Returns the rows that were added.
 
-    return pd.concat([df_points, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_07502():
-    #Marks, lower secondary school
-    #07502: Distribution of pupils by overall achievement marks, by subject, sex and parents' educational attainment level 2009 - 2018
+        Example
+        -------
 
-    #Reading all data
-    df = read_all("07502")
-    #Fixing column names
-    df.columns = ["marks", "subject", 'sex', "education", "contents", "year", "value"]
-
-    #Restructuring - because percent and number of students are in the same column
+            new_rows = refresh_table("07161", "tables/")
+            new_rows = refresh_table("07161", storage=SQLiteStorage("tables/ssb.sqlite"))
+        """
+    storage = storage or DirectoryStorage(store, 'csv')
+    if not storage.exists(table_id):
+        return storage.write(table_id, get_table(table_id, compact=storage.compact))
 
-    df_percent = df.rename(columns={'value': 'percent'})
-    df_percent = df_percent[df_percent.contents == 'Pupils (per cent)']
-    df_percent.reset_index(drop=True, inplace=True)
+    # the catalog may not know about the latest periods yet
+    if _CATALOG is not None:
+        _CATALOG.refresh([table_id])
+    variables = get_variables(table_id)
+    stored = storage.values(table_id, 'year')
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
+    # the time variable is called "Tid" in Statistics Norway, and comes last
+    time_var = next((v for v in variables if v['code'] == 'Tid'), variables[-1])
+    missing = [value for value, text in zip(time_var['values'], time_var['valueTexts'])
+               if value not in stored and text not in stored]
 
+    if not missing:
+        return pd.DataFrame(columns=storage.columns(table_id), dtype=str)
 
-    return pd.concat([df_percent, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_08533():
-    #Marks, lower secondary school
-    #08533: Distribution of pupils, by overall achievement marks, subject, test and mastering level on national tests in 8th grade 2010 - 2018
-    #Reading all data
-    df = read_all("08533")
-    #Fixing column names
-    df.columns = ["marks", "subject", 'test', "education", "contents", "year", "percent"]
+    query = build_query(variables, {time_var['code']: missing})
+    return storage.append(table_id, get_table(table_id, query, compact=storage.compact))
 
 
-    return df.drop(columns=['contents'])
-def get_frame_from_11688():
-    #Marks, lower secondary school
-    #11688: Pupils, by sex and lower secondary school points (C) 2015 - 2018
-    #Reading all data
-    df = read_all("11688")
-    #Fixing column names
-    df.columns = ["region", "sex", 'points', "contents", "year", "value"]
-
-    #Restructuring - because percent and number of students are in the same column
+def get_table_codes():
+    return TABLE_DICT.keys()
 
-    df_percent = df.rename(columns={'value': 'percent'})
-    df_percent = df_percent[df_percent.contents == 'Pupils (per cent)']
-    df_percent.reset_index(drop=True, inplace=True)
+def get_table_titles(refresh=False, catalog=None):
+    """
+        Returns a DataFrame with the code and title of every table in
+        TABLE_DICT. The titles come from the catalog (see set_catalog), or
+        from a temporary one when none is set; the metadata of tables that
+        are missing or stale is fetched in one concurrent pass.
+        refresh=True fetches all of it again.
+        """
+    catalog = catalog or _CATALOG or Catalog()
+    table_codes = list(TABLE_DICT)
 
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
-    return pd.concat([df_percent, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_11689():
-    #Marks, lower secondary school
-    #11689: Pupils, by sex, secondary school points and parents' educational attainment level 2015 - 2018
-    #Reading all data
-    df = read_all("11689")
-    #Fixing column names
-    df.columns = ["sex", "points", 'education', "contents", "year", "value"]
-
-    #Restructuring - because percent and number of students are in the same column
-
-    df_percent = df.rename(columns={'value': 'percent'})
-    df_percent = df_percent[df_percent.contents == 'Pupils (per cent)']
-    df_percent.reset_index(drop=True, inplace=True)
-
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
-    return pd.concat([df_percent, df_pupils.pupils], axis=1).drop(columns=['contents'])
-def get_frame_from_11690():
-    #Marks, lower secondary school
-    #11690: Pupils, by sex, immigration category and lower secondary school points 2015 - 2018
-    #Reading all data
-    df = read_all("11690")
-    #Fixing column names
-    df.columns = ["sex", "background", 'points', "contents", "year", "value"]
-
-    #Restructuring - because percent and number of students are in the same column
-
-    df_percent = df.rename(columns={'value': 'percent'})
-    df_percent = df_percent[df_percent.contents == 'Pupils (per cent)']
-    df_percent.reset_index(drop=True, inplace=True)
-
-    df_pupils = df.rename(columns={'value': 'pupils'})
-    df_pupils = df_pupils[df_pupils.contents == 'Pupils']
-    df_pupils.reset_index(drop=True, inplace=True)
-    return pd.concat([df_percent, df_pupils.pupils], axis=1).drop(columns=['contents'])
-
-
-TABLE_DICT = {"07161": get_frame_from_07161, "07167": get_frame_from_07167,
-                  "07168": get_frame_from_07168, "07170": get_frame_from_07170,
-                  "08558": get_frame_from_08558, "09818": get_frame_from_09818,
-                  "07495": get_frame_from_07495, "07496": get_frame_from_07496,
-                  "07497": get_frame_from_07497, "07498": get_frame_from_07498,
-                  "07499": get_frame_from_07499, "07500": get_frame_from_07500,
-                  "07501": get_frame_from_07501, "07502": get_frame_from_07502,
-                  "08533": get_frame_from_08533, "11688": get_frame_from_11688,
-                  "11689": get_frame_from_11689, "11690": get_frame_from_11690,
-                  "10793": get_frame_from_10793, "10794": get_frame_from_10794
-                  }
-
-
-def create_all_tables(folder="tables/"):
-    table_names = get_table_codes()
-
-    for table in table_names:
-        df = get_table(table).astype(str)
-        df.to_csv(f"{folder}table_{table}.csv", index=False)
-        print(f"Downloaded and created table_{table}")
-    print("Finished creating tables")
-    create_title_file(folder)
+    stale = table_codes if refresh else catalog.stale(table_codes)
+    if stale:
+        catalog.refresh(stale)
 
+    return pd.DataFrame({'table_code': table_codes,
+                         'title': [catalog.title(table_code) for table_code in table_codes]})
 
-def create_title_file(folder="tables/"):
-    df = get_table_titles().astype(str)
-    df.to_csv(f"{folder}titles.csv", index=False)
-    print("Finished creating title fil e")
 
+# The async api, imported with asyncio when first used
+_AIO_NAMES = ('AsyncSSBClient', 'get_async_client', 'set_async_client',
+              'aget_variables', 'aread_with_json', 'aread_all', 'asearch', 'aget_table')
 
-def get_table(table):
-    # Also sorts the table
-    df = TABLE_DICT[table]()
-    return pd.DataFrame({x: df[x].sort_values().values for x in df.columns.values})
 
+def __getattr__(name):
+    if name in _AIO_NAMES:
+        from . import aio
+        return getattr(aio, name)
 
-def get_table_codes():
-    return TABLE_DICT.keys()
+    # The per-table accessors get_frame_from_07161() etc. of earlier versions
+    if name.startswith('get_frame_from_') and name[len('get_frame_from_'):] in TABLE_DICT:
+        return TABLE_DICT[name[len('get_frame_from_'):]]
 
-def get_table_titles():
-    df = pd.DataFrame(columns=('table_code', 'title'))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    for table_code in TABLE_DICT:
-        res = search(table_code)
-        title = res.iloc[0, 0]
-        df = df.append({'table_code': table_code, 'title': title}, ignore_index=True)
 
-    return df
+def __dir__():
+    return [*globals(), *_AIO_NAMES, *(f"get_frame_from_{table_id}" for table_id in TABLE_DICT)]
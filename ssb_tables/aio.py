@@ -0,0 +1,303 @@
+# coding: utf-8
+
+#Async versions of the functions that talk to the Statistics Norway API, for use inside asyncio services
+
+import asyncio
+import io
+import json
+import time
+from urllib.parse import urlparse
+
+from . import metrics
+from . import (TABLE_SPECS, apply_spec, build_query, compact_dtypes, get_catalog, sort_columns,
+               sort_table, spec_selections, split_query, _assemble_chunks, _format_search)
+from .cache import cache_key
+from .client import BASE_URL, RETRY_STATUSES, SSBClient
+from .jsonstat import decode_json_stat
+from .lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+class AsyncSSBClient:
+    """
+        The async counterpart of SSBClient, built on a pooled
+        httpx.AsyncClient. Decoding and clean-up of the tables, which are
+        CPU-bound, run in an executor so they do not stall the event loop.
+        Needs httpx.
+
+        Example
+        -------
+
+            async with AsyncSSBClient() as client:
+                df = await aget_table("07161", client=client)
+
+
+        Parameters
+        ----------
+
+        executor: concurrent.futures.Executor or None
+            Where decoding runs. None uses the event loop's default executor.
+
+        The other parameters are those of SSBClient.
+        """
+
+    def __init__(self,
+                 base_url=BASE_URL,
+                 language='en',
+                 timeout=(5, 120),
+                 max_retries=5,
+                 backoff_factor=0.5,
+                 pool_size=10,
+                 max_per_host=4,
+                 requests_per_second=None,
+                 cache=None,
+                 executor=None):
+        import httpx
+
+        self.base_url = base_url
+        self.language = language
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_per_host = max_per_host
+        self.requests_per_second = requests_per_second
+        self.cache = cache
+        self.executor = executor
+        self._semaphores = {}
+        self._next_start = {}
+
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.session = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.session.aclose()
+
+    # the urls are built the same way as for the blocking client
+    table_url = SSBClient.table_url
+    search_url = SSBClient.search_url
+
+    async def run(self, func, *args):
+        # Runs CPU-bound work in the executor
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _wait_for_slot(self, host):
+        if self.requests_per_second:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + 1.0 / self.requests_per_second
+            await asyncio.sleep(start - now)
+
+    async def request(self, method, url, **kwargs):
+        """
+            Sends a request, limited per host, retrying with exponential
+            backoff on connection errors, HTTP 429 and 5xx responses.
+            Returns the httpx.Response.
+            """
+        import httpx
+
+        host = urlparse(url).netloc
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.max_per_host))
+
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff_factor * 2 ** attempt
+            if attempt:
+                metrics.count('retries')
+            metrics.count('requests')
+            try:
+                async with semaphore:
+                    await self._wait_for_slot(host)
+                    response = await self.session.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                # honour Retry-After when the server tells us how long to wait
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                await asyncio.sleep(delay)
+                continue
+
+            # unlike requests, httpx counts 304 Not Modified as an error
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+
+    async def fetch(self, method, url, query=None, language=None):
+        """
+            Returns the response body, going through the cache when one is
+            set, like SSBClient.fetch. The cache is read and written in the
+            executor.
+            """
+        import httpx
+
+        cache = self.cache
+        if cache is None:
+            body = (await self.request(method, url, json=query)).content
+            metrics.count('bytes', len(body))
+            return body
+
+        key = cache_key(url, language or self.language, query)
+        entry = await self.run(cache.get, key)
+        if entry is not None and cache.is_fresh(entry):
+            metrics.count('cache_hits')
+            return entry['body']
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = await self.request(method, url, json=query, headers=headers)
+        except httpx.TransportError:
+            if entry is None:
+                raise
+            metrics.count('cache_stale')
+            return entry['body']
+
+        if response.status_code == 304:
+            metrics.count('cache_hits')
+            await self.run(cache.touch, key)
+            return entry['body']
+
+        metrics.count('cache_misses')
+        metrics.count('bytes', len(response.content))
+        await self.run(lambda: cache.set(key, response.content,
+                                         etag=response.headers.get('ETag'),
+                                         last_modified=response.headers.get('Last-Modified')))
+        return response.content
+
+
+_CLIENT = None
+
+
+def get_async_client():
+    """
+        Returns the AsyncSSBClient used by functions that are not given one,
+        creating it on first use. Its connections belong to the event loop
+        it is first used in; services with several loops should pass a
+        client of their own.
+        """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = AsyncSSBClient()
+    return _CLIENT
+
+
+def set_async_client(client):
+    global _CLIENT
+    _CLIENT = client
+
+
+async def aget_variables(table_id=None, language=None, base_url=None, full_url=None, client=None):
+    # a fresh catalog entry saves the request, see set_catalog
+    catalog = get_catalog()
+    if (catalog is not None and table_id is not None and full_url is None and base_url is None
+            and not catalog.is_stale(table_id, language)):
+        return catalog.variables(table_id, language)
+
+    client = client or get_async_client()
+    if full_url is None:
+        full_url = client.table_url(table_id, language, base_url)
+
+    return json.loads(await client.fetch('GET', full_url, language=language))['variables']
+
+
+async def _apost_query(client, full_url, query, language=None, max_cells=None, ordered=False):
+    # Posts the query, split into chunks that are fetched concurrently when it
+    # asks for more than max_cells cells, see _post_query
+    chunks = split_query(query, max_cells)
+    bodies = await asyncio.gather(*[client.fetch('POST', full_url, query=chunk, language=language)
+                                    for chunk, _ in chunks])
+
+    if len(chunks) == 1:
+        return await client.run(decode_json_stat, bodies[0])
+
+    def decode():
+        frames = [decode_json_stat(body) for body in bodies]
+        return _assemble_chunks(frames, chunks, query, ordered)
+
+    return await client.run(decode)
+
+
+async def aread_with_json(table_id=None, query=None, language=None, base_url=None, full_url=None,
+                          client=None, max_cells=None, selections=None):
+    client = client or get_async_client()
+
+    if query is None:
+        variables = await aget_variables(table_id, language, base_url, full_url, client)
+        query = build_query(variables, selections)
+
+    if full_url is None:
+        full_url = client.table_url(table_id, language, base_url)
+
+    return await _apost_query(client, full_url, query, language, max_cells)
+
+
+async def aread_all(table_id=None, language=None, base_url=None, full_url=None,
+                    client=None, max_cells=None):
+    client = client or get_async_client()
+
+    variables = await aget_variables(table_id, language, base_url, full_url, client)
+    query = build_query(variables)
+
+    if full_url is None:
+        full_url = client.table_url(table_id, language, base_url)
+
+    return await _apost_query(client, full_url, query, language, max_cells, ordered=True)
+
+
+async def asearch(phrase, language=None, base_url=None, client=None):
+    """
+        Async version of search.
+        """
+    client = client or get_async_client()
+    body = await client.fetch('GET', client.search_url(phrase, language, base_url), language=language)
+    return _format_search(pd.read_json(io.BytesIO(body)))
+
+
+async def aget_table(table, query=None, sort=True, by=None, compact=True, client=None, **selections):
+    """
+        Async version of get_table.
+        """
+    client = client or get_async_client()
+    with metrics.table_context(table):
+        return await _aget_table(table, query, sort, by, compact, client, selections)
+
+
+async def _aget_table(table, query, sort, by, compact, client, selections):
+    if selections:
+        if query is not None:
+            raise ValueError("Give either a query or selections, not both")
+        variables = await aget_variables(table, client=client)
+        query = build_query(variables, spec_selections(table, variables, selections))
+
+    if query is None:
+        df = await aread_all(table, client=client)
+    else:
+        df = await aread_with_json(table, query, client=client)
+
+    def clean_up():
+        frame = apply_spec(df, TABLE_SPECS[table])
+        if compact:
+            frame = compact_dtypes(frame)
+        if not sort:
+            return frame
+        return sort_table(frame, by or sort_columns(table))
+
+    return await client.run(clean_up)
@@ -0,0 +1,214 @@
+# coding: utf-8
+
+#Response caches for the SSB API, so that unchanged tables are not downloaded again
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def cache_key(full_url, language=None, query=None):
+    """
+        Returns the cache key of a request: a hash of the url, the language
+        and the query with its keys sorted, so that equal queries written in
+        a different order share an entry.
+        """
+    canonical = json.dumps(query, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    raw = '{}\n{}\n{}'.format(full_url, language, canonical)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+        Base class of the response caches. An entry is a dict with the keys
+        body, etag, last_modified and stored (the time it was last fetched or
+        revalidated).
+
+        Parameters
+        ----------
+
+        ttl: float or None
+            Seconds an entry is served without asking the server.
+            Older entries are revalidated with If-None-Match/If-Modified-Since.
+            None means entries never go stale.
+
+        max_size: int or None
+            Maximum total size of the cached bodies in bytes. The least
+            recently used entries are evicted first. None means no limit.
+        """
+
+    def __init__(self, ttl=24 * 60 * 60, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def is_fresh(self, entry):
+        return self.ttl is None or time.time() - entry['stored'] < self.ttl
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, body, etag=None, last_modified=None):
+        raise NotImplementedError
+
+    def touch(self, key):
+        # Marks an entry as revalidated, restarting its ttl
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class FileCache(ResponseCache):
+    """
+        Caches responses as files in a folder, one body file and one small
+        json file with the validators per entry.
+
+        Example
+        -------
+
+            set_cache(FileCache("~/.cache/ssb_tables", ttl=3600))
+        """
+
+    def __init__(self, folder, ttl=24 * 60 * 60, max_size=None):
+        super().__init__(ttl, max_size)
+        self.folder = os.path.expanduser(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _paths(self, key):
+        base = os.path.join(self.folder, key)
+        return base + '.body', base + '.json'
+
+    def _write(self, path, data):
+        # Write to a temporary file first so readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                entry['body'] = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # the modification time of the body file doubles as the lru timestamp
+        os.utime(body_path)
+        return entry
+
+    def set(self, key, body, etag=None, last_modified=None):
+        body_path, meta_path = self._paths(key)
+        meta = {'etag': etag, 'last_modified': last_modified, 'stored': time.time()}
+        with self._lock:
+            self._write(body_path, body)
+            self._write(meta_path, json.dumps(meta).encode('utf-8'))
+            self._evict()
+
+    def touch(self, key):
+        body_path, meta_path = self._paths(key)
+        with self._lock:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta['stored'] = time.time()
+            self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+
+        bodies = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.body'):
+                stat = os.stat(os.path.join(self.folder, name))
+                bodies.append((stat.st_mtime, stat.st_size, name[:-len('.body')]))
+
+        total = sum(size for _, size, _ in bodies)
+        for _, size, key in sorted(bodies):
+            if total <= self.max_size:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.folder):
+                if name.endswith(('.body', '.json')):
+                    os.remove(os.path.join(self.folder, name))
+
+
+class SQLiteCache(ResponseCache):
+    """
+        Caches responses in a single SQLite database file.
+
+        Example
+        -------
+
+            set_cache(SQLiteCache("ssb_cache.sqlite", max_size=500 * 2**20))
+        """
+
+    def __init__(self, path, ttl=24 * 60 * 60, max_size=None):
+        import sqlite3
+
+        super().__init__(ttl, max_size)
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, '
+                'stored REAL, accessed REAL, size INTEGER)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT body, etag, last_modified, stored FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        body, etag, last_modified, stored = row
+        return {'body': bytes(body), 'etag': etag, 'last_modified': last_modified, 'stored': stored}
+
+    def set(self, key, body, etag=None, last_modified=None):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, body, etag, last_modified, now, now, len(body)))
+            self._evict()
+
+    def touch(self, key):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE responses SET stored = ? WHERE key = ?', (time.time(), key))
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+
+        total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        rows = self._connection.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM responses')
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+#Local catalog of the metadata of Statistics Norway tables, so that it need not be fetched for every download
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from . import metrics
+
+
+class Catalog:
+    """
+        Metadata of a set of tables: title, variables (codes, values and
+        value texts), when Statistics Norway last published the table and
+        when the entry was fetched. Entries are kept per language and saved
+        to a json file, so they survive between runs.
+
+        Example
+        -------
+
+            catalog = Catalog("tables/catalog.json")
+            catalog.refresh(get_table_codes())
+            set_catalog(catalog)
+
+
+        Parameters
+        ----------
+
+        path: string or None
+            File the catalog is loaded from and saved to. None keeps it in
+            memory only.
+
+        client: SSBClient or None
+            Client the metadata is fetched with. None uses the default one.
+
+        max_age: float or None
+            Seconds before an entry is stale and fetched again when it is
+            used. None means entries never go stale; use refresh to update.
+
+        max_workers: int
+            Number of tables fetched concurrently by refresh.
+        """
+
+    def __init__(self, path=None, client=None, max_age=7 * 24 * 60 * 60, max_workers=8):
+        self.path = os.path.expanduser(path) if path else None
+        self._client = client
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.tables = {}
+        self._lock = threading.Lock()
+
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.tables = json.load(f)
+
+    @property
+    def client(self):
+        if self._client is None:
+            from . import get_client
+            return get_client()
+        return self._client
+
+    def _language(self, language):
+        return language or self.client.language
+
+    def entry(self, table_id, language=None):
+        """
+            Returns the catalog entry of a table, fetching it first if it is
+            missing or stale.
+            """
+        language = self._language(language)
+        if self.is_stale(table_id, language):
+            self.refresh([table_id], language)
+        return self.tables[language][table_id]
+
+    def variables(self, table_id, language=None):
+        return self.entry(table_id, language)['variables']
+
+    def title(self, table_id, language=None):
+        return self.entry(table_id, language)['title']
+
+    def is_stale(self, table_id, language=None):
+        entry = self.tables.get(self._language(language), {}).get(table_id)
+        if entry is None:
+            return True
+        return self.max_age is not None and time.time() - entry['fetched'] > self.max_age
+
+    def stale(self, table_ids, language=None):
+        return [table_id for table_id in table_ids if self.is_stale(table_id, language)]
+
+    def refresh(self, table_ids=None, language=None):
+        """
+            Fetches the metadata of the tables concurrently, all the tables
+            in the catalog if table_ids is None, and saves the catalog.
+            """
+        from concurrent.futures import ThreadPoolExecutor
+
+        language = self._language(language)
+        if table_ids is None:
+            table_ids = list(self.tables.get(language, {}))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            entries = list(executor.map(lambda table_id: self._fetch(table_id, language), table_ids))
+
+        with self._lock:
+            self.tables.setdefault(language, {}).update(zip(table_ids, entries))
+        self.save()
+
+    def _fetch(self, table_id, language):
+        with metrics.table_context(table_id), metrics.stage('metadata'):
+            return self._fetch_entry(table_id, language)
+
+    def _fetch_entry(self, table_id, language):
+        client = self.client
+        metadata = json.loads(client.fetch('GET', client.table_url(table_id, language), language=language))
+
+        # the publishing date is only found through the search
+        results = json.loads(client.fetch('GET', client.search_url(table_id, language), language=language))
+        published = next((result.get('published') for result in results
+                          if result.get('id') == table_id), None)
+
+        return {'title': metadata['title'].split(':', 1)[-1].strip(),
+                'variables': metadata['variables'],
+                'updated': published,
+                'fetched': time.time()}
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            data = json.dumps(self.tables, ensure_ascii=False)
+
+        # write to a temporary file first so a crash never leaves half a catalog
+        folder = os.path.dirname(self.path) or '.'
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
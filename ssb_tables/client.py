@@ -0,0 +1,242 @@
+# coding: utf-8
+
+#HTTP client shared by all the functions that talk to the Statistics Norway API
+
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from . import metrics
+from .cache import cache_key
+from .lazy import LazyModule
+
+requests = LazyModule('requests')
+
+
+BASE_URL = 'http://data.ssb.no/api/v0'
+
+# Statuses that are worth retrying: rate limited or a transient server error
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+        Limits the number of concurrent requests against each host and,
+        optionally, the number of requests started per second.
+
+        Parameters
+        ----------
+
+        max_per_host: int
+            Maximum number of requests in flight against one host.
+
+        requests_per_second: float or None
+            Maximum rate at which requests are started against one host.
+            None means no rate limit.
+        """
+
+    def __init__(self, max_per_host=4, requests_per_second=None):
+        self.max_per_host = max_per_host
+        self.requests_per_second = requests_per_second
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    @contextmanager
+    def slot(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            semaphore = self._semaphores[host]
+
+        with semaphore:
+            if self.requests_per_second:
+                # reserve the next start time for this host, then wait for it
+                with self._lock:
+                    now = time.monotonic()
+                    start = max(now, self._next_start.get(host, now))
+                    self._next_start[host] = start + 1.0 / self.requests_per_second
+                time.sleep(max(0.0, start - now))
+            yield
+
+
+class SSBClient:
+    """
+        Owns one pooled requests.Session that every request to the API goes
+        through, together with the timeouts, retry policy, rate limit and
+        response cache that apply to it.
+
+        Example
+        -------
+
+            client = SSBClient(language='no', timeout=(5, 300))
+            df = read_all("07161", client=client)
+
+            # or make it the default for all functions
+            set_client(client)
+
+
+        Parameters
+        ----------
+
+        base_url: string
+            default in Statistics Norway: 'http://data.ssb.no/api/v0'
+
+        language: string
+            Default language of the requests, 'en' or 'no'.
+
+        timeout: float or (float, float)
+            Connect and read timeouts in seconds, passed on to requests.
+
+        max_retries: int
+            Retries on connection errors, HTTP 429 and 5xx, with exponential
+            backoff starting at backoff_factor seconds.
+
+        pool_size: int
+            Number of keep-alive connections kept open per host.
+
+        max_per_host, requests_per_second:
+            Passed on to the RateLimiter.
+
+        cache: ResponseCache or None
+            Cache the responses go through, see FileCache and SQLiteCache.
+        """
+
+    def __init__(self,
+                 base_url=BASE_URL,
+                 language='en',
+                 timeout=(5, 120),
+                 max_retries=5,
+                 backoff_factor=0.5,
+                 pool_size=10,
+                 max_per_host=4,
+                 requests_per_second=None,
+                 cache=None):
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url
+        self.language = language
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.limiter = RateLimiter(max_per_host, requests_per_second)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip, deflate'})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def table_url(self, table_id, language=None, base_url=None):
+        return '{base_url}/{language}/table/{table_id}'.format(
+            base_url=base_url or self.base_url,
+            language=language or self.language,
+            table_id=table_id)
+
+    def search_url(self, phrase, language=None, base_url=None):
+        search_str = '{base_url}/{language}/table/?query={phrase}'.format(
+            base_url=base_url or self.base_url,
+            language=language or self.language,
+            phrase=phrase)
+
+        # todo: make converter part of the default specification only for statistics norway
+        convert = {'æ': '%C3%A6', 'Æ': '%C3%86', 'ø': '%C3%B8', 'Ø': '%C3%98',
+                   'å': '%C3%A5', 'Å': '%C3%85',
+                   '"': '%22', '(': '%28', ')': '%29', ' ': '%20'}
+
+        for k, v in convert.items():
+            search_str = search_str.replace(k, v)
+
+        return search_str
+
+    def request(self, method, url, **kwargs):
+        """
+            Sends a request through the rate limiter, retrying with exponential
+            backoff on connection errors, HTTP 429 and 5xx responses.
+            Returns the requests.Response.
+            """
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff_factor * 2 ** attempt
+            if attempt:
+                metrics.count('retries')
+            metrics.count('requests')
+            try:
+                with self.limiter.slot(host):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                # honour Retry-After when the server tells us how long to wait
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def fetch(self, method, url, query=None, language=None):
+        """
+            Returns the response body of a GET (query=None) or a POST of the
+            json query, going through the cache when one is set. Stale entries
+            are revalidated, and served as they are if the server cannot be
+            reached.
+            """
+        cache = self.cache
+        if cache is None:
+            body = self.request(method, url, json=query).content
+            metrics.count('bytes', len(body))
+            return body
+
+        key = cache_key(url, language or self.language, query)
+        entry = cache.get(key)
+        if entry is not None and cache.is_fresh(entry):
+            metrics.count('cache_hits')
+            return entry['body']
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self.request(method, url, json=query, headers=headers)
+        except (requests.ConnectionError, requests.Timeout):
+            if entry is None:
+                raise
+            metrics.count('cache_stale')
+            return entry['body']
+
+        if response.status_code == 304:
+            metrics.count('cache_hits')
+            cache.touch(key)
+            return entry['body']
+
+        metrics.count('cache_misses')
+        metrics.count('bytes', len(response.content))
+        cache.set(key, response.content,
+                  etag=response.headers.get('ETag'),
+                  last_modified=response.headers.get('Last-Modified'))
+        return response.content
@@ -0,0 +1,103 @@
+# coding: utf-8
+
+#Decoder for json-stat responses, turning them into DataFrames without going through pyjstat
+
+import json
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+
+def decode_json_stat(body):
+    """
+        Decodes a json-stat response (version 1.x as returned by Statistics
+        Norway, or 2.0) into a DataFrame with one column per dimension and
+        a 'value' column, like pyjstat.from_json_stat(...)[0].
+
+        The dimensions are categoricals built from the cartesian product of
+        the category codes, so no label is repeated as a Python string,
+        and the values go straight into a float array.
+
+        Parameters
+        ----------
+
+        body: bytes, string or dict
+            The response body, or the json already parsed.
+        """
+    data = json.loads(body) if isinstance(body, (bytes, bytearray, str)) else body
+
+    if data.get('class') == 'dataset' or 'id' in data:
+        dataset = data
+        ids, sizes = data['id'], data['size']
+    else:
+        dataset = data['dataset'] if 'dataset' in data else next(iter(data.values()))
+        ids, sizes = dataset['dimension']['id'], dataset['dimension']['size']
+
+    n = int(np.prod(sizes, dtype=np.int64))
+    values = _decode_values(dataset.get('value', []), n)
+
+    columns = {}
+    inner = n
+    for dim_id, size in zip(ids, sizes):
+        dimension = dataset['dimension'][dim_id]
+        labels = _category_labels(dimension.get('category', {}), size)
+
+        # the codes of a dimension repeat each category 'inner' times, and
+        # that block 'outer' times, json-stat being in row-major order
+        inner //= max(size, 1)
+        outer = n // max(size * inner, 1)
+        codes = np.tile(np.repeat(np.arange(size, dtype=_code_dtype(size)), inner), outer)
+
+        # labels need not be unique, categories must be
+        label_codes, categories = pd.factorize(np.asarray(labels, dtype=object))
+        if len(categories) < size:
+            codes = label_codes[codes].astype(codes.dtype)
+
+        columns[dimension.get('label', dim_id)] = pd.Categorical.from_codes(codes, categories=categories)
+
+    columns['value'] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def _category_labels(category, size):
+    # The labels of a dimension's categories in index order, falling back on
+    # the category codes where there are no labels
+    index = category.get('index')
+    label = category.get('label', {})
+
+    if index is None:
+        codes = list(label)
+    elif isinstance(index, dict):
+        codes = sorted(index, key=index.get)
+    else:
+        codes = list(index)
+
+    if len(codes) != size:
+        raise ValueError(f"Dimension has {len(codes)} categories, expected {size}")
+
+    return [label.get(code, code) for code in codes]
+
+
+def _code_dtype(size):
+    if size < 2 ** 7:
+        return np.int8
+    if size < 2 ** 15:
+        return np.int16
+    return np.int32
+
+
+def _decode_values(value, n):
+    # Dense values come as a list, sparse ones as a dict of position -> value
+    if isinstance(value, dict):
+        values = np.full(n, np.nan)
+        for position, number in value.items():
+            if number is not None:
+                values[int(position)] = number
+        return values
+
+    values = np.array(value, dtype=np.float64)
+    if len(values) != n:
+        raise ValueError(f"Got {len(values)} values, expected {n}")
+    return values
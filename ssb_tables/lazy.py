@@ -0,0 +1,30 @@
+# coding: utf-8
+
+#Deferred imports of the heavy dependencies, so that importing ssb_tables stays cheap
+
+import importlib
+
+
+class LazyModule:
+    """
+        Stands in for a module that is only imported the first time one of
+        its attributes is used. After that its attributes are looked up as
+        quickly as those of the module itself.
+
+        Example
+        -------
+
+            pd = LazyModule('pandas')
+            pd.DataFrame()  # imports pandas
+        """
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._lazy_name!r}>"
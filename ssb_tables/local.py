@@ -0,0 +1,267 @@
+# coding: utf-8
+
+#Queries over the tables stored locally by create_all_tables in the parquet or feather format
+
+import os
+import threading
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+
+class LocalTable:
+    """
+        A stored table, memory-mapped if it is a feather file (a parquet
+        file is decoded into memory), with an index on each dimension
+        column: the code of every row, and the rows of every label. The
+        index of a column is built the first time it is used, and a lookup
+        starts from the rows of its most selective filter, so repeated point
+        lookups only touch the rows they return.
+
+        Parameters
+        ----------
+
+        path: string
+            A .parquet or .feather file written by create_all_tables.
+        """
+
+    def __init__(self, path):
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        if path.endswith('.parquet'):
+            table = pq.read_table(path, memory_map=True)
+        else:
+            table = feather.read_table(path, memory_map=True)
+
+        # row groups may come with dictionaries of their own
+        self.table = table.unify_dictionaries()
+        self.num_rows = self.table.num_rows
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def is_dimension(self, column):
+        import pyarrow as pa
+        return pa.types.is_dictionary(self.table.schema.field(column).type)
+
+    def index(self, column):
+        """
+            Returns the index of a dimension column: a dict with the codes of
+            its rows, its labels as a pandas Index, and the sorted positions
+            of the rows of each code.
+            """
+        return self._column(column)
+
+    def _column(self, column):
+        # The column as numpy arrays, built once: codes and labels of
+        # dimensions, values (and a mask of the missing ones) of measures
+        with self._lock:
+            if column in self._columns:
+                return self._columns[column]
+
+            import pyarrow as pa
+
+            array = self.table.column(column).combine_chunks()
+            field = self.table.schema.field(column)
+
+            if pa.types.is_dictionary(field.type):
+                codes = array.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+                labels = pd.Index(array.dictionary.to_pylist())
+
+                # rows grouped by code, in row order within each group
+                order = np.argsort(codes, kind='stable')
+                bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+                entry = {'kind': 'dimension', 'codes': codes, 'labels': labels,
+                         'positions': {label: order[bounds[i]:bounds[i + 1]] for i, label in enumerate(labels)}}
+
+            elif pa.types.is_integer(field.type):
+                mask = array.is_null().to_numpy(zero_copy_only=False)
+                values = array.fill_null(0).to_numpy(zero_copy_only=False)
+                entry = {'kind': 'integer', 'values': values, 'mask': mask}
+
+            elif pa.types.is_floating(field.type):
+                entry = {'kind': 'float', 'values': array.to_numpy(zero_copy_only=False)}
+
+            else:
+                entry = {'kind': 'other', 'array': array}
+
+            self._columns[column] = entry
+            return entry
+
+    def _take(self, column, positions):
+        # The values of a column at the positions, as a pandas array
+        entry = self._column(column)
+        kind = entry['kind']
+        if kind == 'dimension':
+            return pd.Categorical.from_codes(entry['codes'][positions], categories=entry['labels'])
+        if kind == 'integer':
+            return pd.arrays.IntegerArray(entry['values'][positions].astype(np.int64),
+                                          entry['mask'][positions])
+        if kind == 'float':
+            return entry['values'][positions]
+        return entry['array'].take(positions).to_pandas()
+
+    def rows(self, column, condition):
+        """
+            Returns the sorted positions of the rows of a column that meet
+            the condition.
+            """
+        entry = self._column(column)
+        if entry['kind'] == 'dimension':
+            labels = _labels(entry['positions'], condition)
+            if len(labels) == 1:
+                return entry['positions'][labels[0]]
+            if not labels:
+                return np.array([], dtype=np.intp)
+            return np.sort(np.concatenate([entry['positions'][label] for label in labels]))
+
+        return np.flatnonzero(self._mask(column, condition, slice(None)))
+
+    def _mask(self, column, condition, positions):
+        # Which of the rows at the positions meet the condition
+        entry = self._column(column)
+        if entry['kind'] == 'dimension':
+            codes = entry['labels'].get_indexer(_labels(entry['positions'], condition))
+            return np.isin(entry['codes'][positions], codes)
+
+        values = pd.Series(self._take(column, positions))
+        if isinstance(condition, slice):
+            mask = np.ones(len(values), dtype=bool)
+            if condition.start is not None:
+                mask &= (values >= condition.start).fillna(False).to_numpy(dtype=bool)
+            if condition.stop is not None:
+                mask &= (values <= condition.stop).fillna(False).to_numpy(dtype=bool)
+            return mask
+        if isinstance(condition, (list, tuple, set, frozenset)):
+            return values.isin(list(condition)).to_numpy(dtype=bool)
+        return (values == condition).fillna(False).to_numpy(dtype=bool)
+
+    def query(self, filters=None, columns=None):
+        """
+            Returns the rows that meet all filters, with only the columns
+            asked for, as a DataFrame.
+            """
+        filters = dict(filters or {})
+        columns = list(columns) if columns is not None else self.table.column_names
+
+        # start from the dimension filter that leaves the fewest rows, then
+        # narrow down with the others on just those rows
+        dimensions = [column for column in filters if self.is_dimension(column)]
+        if dimensions:
+            candidates = {column: self.rows(column, filters[column]) for column in dimensions}
+            first = min(candidates, key=lambda column: len(candidates[column]))
+            positions = candidates.pop(first)
+            del filters[first]
+        else:
+            positions = np.arange(self.num_rows)
+
+        for column, condition in filters.items():
+            if len(positions) == 0:
+                break
+            positions = positions[self._mask(column, condition, positions)]
+
+        return pd.DataFrame({column: self._take(column, positions) for column in columns})
+
+    def to_pandas(self, columns=None):
+        """
+            Returns the whole table as a DataFrame whose columns are views
+            of the memory-mapped file (pandas ArrowDtype), dimensions still
+            dictionary-encoded, so nothing is copied. The columns are
+            read-only. The table id and title are put in df.attrs.
+            """
+        table = self.table if columns is None else self.table.select(columns)
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+
+        metadata = self.table.schema.metadata or {}
+        df.attrs['table_id'] = metadata.get(b'ssb_table_id', b'').decode('utf-8')
+        df.attrs['title'] = metadata.get(b'ssb_title', b'').decode('utf-8')
+        return df
+
+
+def _labels(positions, condition):
+    # The labels of a dimension that meet a condition: a value, a list of
+    # values or a slice of labels, both ends included
+    if isinstance(condition, slice):
+        return [label for label in positions if _in_slice(label, condition)]
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return [str(value) for value in condition if str(value) in positions]
+    return [str(condition)] if str(condition) in positions else []
+
+
+def _in_slice(label, condition):
+    return ((condition.start is None or label >= str(condition.start)) and
+            (condition.stop is None or label <= str(condition.stop)))
+
+
+def _expression(field, condition):
+    # The condition as a pyarrow compute expression on a column
+    import pyarrow.compute as pc
+
+    if isinstance(condition, slice):
+        expression = None
+        if condition.start is not None:
+            expression = field >= condition.start
+        if condition.stop is not None:
+            upper = field <= condition.stop
+            expression = upper if expression is None else expression & upper
+        if expression is None:
+            expression = pc.scalar(True)
+    elif isinstance(condition, (list, tuple, set, frozenset)):
+        expression = field.isin(list(condition))
+    else:
+        expression = field == condition
+
+    return expression
+
+
+_OPEN_TABLES = {}
+_OPEN_LOCK = threading.Lock()
+
+
+def open_table(path):
+    """
+        Returns the LocalTable of a file, opening it only once per process
+        and again when the file has been rewritten.
+        """
+    with _OPEN_LOCK:
+        table = _OPEN_TABLES.get(path)
+        if table is None or table.mtime != os.path.getmtime(path):
+            table = _OPEN_TABLES[path] = LocalTable(path)
+        return table
+
+
+def scan_table(path, filters=None, columns=None):
+    """
+        Reads the rows that meet the filters without loading or indexing the
+        whole table: the filters are pushed down to the file, so that parquet
+        row groups whose statistics rule them out are skipped.
+        """
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet' if path.endswith('.parquet') else 'feather')
+
+    expression = None
+    for column, condition in (filters or {}).items():
+        part = _expression(pc.field(column), _as_strings(condition, dataset.schema.field(column)))
+        expression = part if expression is None else expression & part
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def _as_strings(condition, field):
+    # Dimension labels are stored as strings, so compare them with strings
+    import pyarrow as pa
+
+    if not pa.types.is_dictionary(field.type):
+        return condition
+    if isinstance(condition, slice):
+        return slice(None if condition.start is None else str(condition.start),
+                     None if condition.stop is None else str(condition.stop))
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return [str(value) for value in condition]
+    return str(condition)
@@ -0,0 +1,177 @@
+# coding: utf-8
+
+#Timings and counters of the work done for each table, for finding out where a slow download spends its time
+
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The table the current thread or task is working on
+_TABLE = contextvars.ContextVar('ssb_table', default=None)
+
+_RECORDERS = []
+_RECORDERS_LOCK = threading.Lock()
+
+# Counters, with the help text of their Prometheus metric
+COUNTERS = {'requests': "HTTP requests sent, retries included",
+            'retries': "Requests retried after an error or a 429/5xx response",
+            'bytes': "Bytes of response bodies received",
+            'cache_hits': "Responses served from the cache, revalidated ones included",
+            'cache_misses': "Responses that had to be downloaded",
+            'cache_stale': "Stale cached responses served because the server could not be reached",
+            'rows': "Rows of the cleaned-up tables"}
+
+# Stages, in the order a table goes through them
+STAGES = ('metadata', 'post', 'decode', 'reshape', 'sort', 'write')
+
+
+class Metrics:
+    """
+        Records the wall time of each stage (see STAGES) and the counters
+        (see COUNTERS) of each table while it is active. Stages run for
+        several chunks at once add up.
+
+        Every event is also logged at DEBUG level to the ssb_tables.metrics
+        logger, with the table, the name and the value in the extra fields
+        ssb_table, ssb_metric and ssb_value.
+
+        Example
+        -------
+
+            with Metrics() as metrics:
+                create_all_tables("tables/", max_workers=4)
+
+            metrics.to_frame().sort_values('post')
+            open("ssb_tables.prom", "w").write(metrics.prometheus())
+
+
+        Parameters
+        ----------
+
+        callback: function or None
+            Called with (table_id, kind, name, value) for every event, where
+            kind is 'stage' (value in seconds) or 'count'.
+        """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = defaultdict(lambda: defaultdict(float))
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with _RECORDERS_LOCK:
+            _RECORDERS.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _RECORDERS_LOCK:
+            _RECORDERS.remove(self)
+
+    def record(self, table_id, kind, name, value):
+        with self._lock:
+            if kind == 'stage':
+                self.stages[table_id][name] += value
+            else:
+                self.counts[table_id][name] += value
+        if self.callback is not None:
+            self.callback(table_id, kind, name, value)
+
+    def to_frame(self):
+        """
+            Returns a DataFrame with a row per table, the seconds of each
+            stage and the counters. Work done outside any table is on the
+            row with table_id None.
+            """
+        import pandas as pd
+
+        with self._lock:
+            tables = list(dict.fromkeys([*self.stages, *self.counts]))
+            rows = [{'table_id': table_id,
+                     **{stage: self.stages[table_id].get(stage, 0.0) for stage in STAGES},
+                     **{name: self.counts[table_id].get(name, 0) for name in COUNTERS}}
+                    for table_id in tables]
+        return pd.DataFrame(rows, columns=['table_id', *STAGES, *COUNTERS])
+
+    def prometheus(self):
+        """
+            Returns the metrics in the Prometheus text format, for the
+            textfile collector or a push gateway.
+            """
+        lines = ["# HELP ssb_tables_stage_seconds Wall time spent in each stage of a table",
+                 "# TYPE ssb_tables_stage_seconds counter"]
+        with self._lock:
+            for table_id, stages in self.stages.items():
+                for stage, seconds in stages.items():
+                    lines.append(f'ssb_tables_stage_seconds{{table="{table_id or ""}",stage="{stage}"}} {seconds:.6f}')
+
+            for name, help_text in COUNTERS.items():
+                lines += [f"# HELP ssb_tables_{name}_total {help_text}",
+                          f"# TYPE ssb_tables_{name}_total counter"]
+                for table_id, counts in self.counts.items():
+                    if name in counts:
+                        lines.append(f'ssb_tables_{name}_total{{table="{table_id or ""}"}} {counts[name]}')
+
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def table_context(table_id):
+    """
+        Attributes the work done inside it to a table. None keeps the
+        table of the surrounding code.
+        """
+    if table_id is None:
+        yield
+        return
+
+    token = _TABLE.set(table_id)
+    try:
+        yield
+    finally:
+        _TABLE.reset(token)
+
+
+def bind(func):
+    # Wraps func so that it works for the current table in other threads too
+    table_id = _TABLE.get()
+
+    def run(*args, **kwargs):
+        with table_context(table_id):
+            return func(*args, **kwargs)
+    return run
+
+
+@contextmanager
+def stage(name):
+    """
+        Times the code inside it as a stage of the current table.
+        """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start)
+
+
+def timing(name, seconds):
+    # Records a stage timed elsewhere, e.g. in another process
+    _emit('stage', name, seconds)
+
+
+def count(name, amount=1):
+    _emit('count', name, amount)
+
+
+def _emit(kind, name, value):
+    table_id = _TABLE.get()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("table %s: %s %s", table_id, name, value,
+                     extra={'ssb_table': table_id, 'ssb_metric': name, 'ssb_value': value})
+    for recorder in list(_RECORDERS):
+        recorder.record(table_id, kind, name, value)
@@ -0,0 +1,171 @@
+# coding: utf-8
+
+#Inverted index over the titles and variables of the tables in a catalog, for searching without the API
+
+import bisect
+import re
+import threading
+import unicodedata
+
+# Letters that do not decompose into a base letter and an accent
+_FOLD = str.maketrans({'æ': 'ae', 'ø': 'o', 'å': 'a', 'ß': 'ss', 'œ': 'oe', 'đ': 'd', 'ł': 'l'})
+
+# How much a match counts for, by where the word is found
+_WEIGHTS = {'id': 3, 'title': 2, 'variables': 1}
+
+
+def normalize(text):
+    """
+        Folds case and diacritics, so that "Kjønn", "KJØNN" and "kjonn" are
+        the same word.
+        """
+    text = str(text).casefold().translate(_FOLD)
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return re.findall(r'\w+', normalize(text))
+
+
+class SearchIndex:
+    """
+        The words of the table ids, titles, variable names and value texts
+        in a Catalog, per language, with the tables each word occurs in.
+        update() only indexes the entries that were added or fetched again
+        since the last time.
+
+        Example
+        -------
+
+            index = SearchIndex(catalog)
+            index.search("pharma* export", 'en')
+
+
+        Parameters
+        ----------
+
+        catalog: Catalog
+            The catalog to index. Fill it for the languages to search in,
+            e.g. catalog.refresh(table_ids, 'no').
+        """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._postings = {}   # language -> word -> {table_id: weight}
+        self._words = {}      # language -> sorted words, None when out of date
+        self._indexed = {}    # (language, table_id) -> (fetched, words)
+        self.update()
+
+    def update(self):
+        """
+            Indexes the catalog entries that are new or have been fetched
+            again, and drops those that are gone.
+            """
+        with self._lock:
+            seen = set()
+            for language, entries in list(self.catalog.tables.items()):
+                for table_id, entry in list(entries.items()):
+                    key = (language, table_id)
+                    seen.add(key)
+                    indexed = self._indexed.get(key)
+                    if indexed is None or indexed[0] != entry.get('fetched'):
+                        self._remove(key)
+                        self._add(key, entry)
+
+            for key in set(self._indexed) - seen:
+                self._remove(key)
+
+    def _add(self, key, entry):
+        language, table_id = key
+        weights = {}
+        fields = {'id': [table_id],
+                  'title': [entry.get('title', '')],
+                  'variables': [text for variable in entry.get('variables', [])
+                                for text in [variable.get('text', ''), *variable.get('valueTexts', [])]]}
+        for field, texts in fields.items():
+            for text in texts:
+                for word in tokenize(text):
+                    weights[word] = max(weights.get(word, 0), _WEIGHTS[field])
+
+        postings = self._postings.setdefault(language, {})
+        for word, weight in weights.items():
+            postings.setdefault(word, {})[table_id] = weight
+        self._indexed[key] = (entry.get('fetched'), list(weights))
+        self._words[language] = None
+
+    def _remove(self, key):
+        language, table_id = key
+        indexed = self._indexed.pop(key, None)
+        if indexed is None:
+            return
+        postings = self._postings[language]
+        for word in indexed[1]:
+            tables = postings[word]
+            del tables[table_id]
+            if not tables:
+                del postings[word]
+        self._words[language] = None
+
+    def _matches(self, language, term):
+        # {table_id: weight} of the tables with the term, a word or a prefix*
+        postings = self._postings.get(language, {})
+        if not term.endswith('*'):
+            return postings.get(term, {})
+
+        words = self._words.get(language)
+        if words is None:
+            words = self._words[language] = sorted(postings)
+
+        prefix = term.rstrip('*')
+        matches = {}
+        for word in words[bisect.bisect_left(words, prefix):]:
+            if not word.startswith(prefix):
+                break
+            for table_id, weight in postings[word].items():
+                matches[table_id] = max(matches.get(table_id, 0), weight)
+        return matches
+
+    def search(self, phrase, language):
+        """
+            Returns (table_id, score) of the tables that have every word of
+            the phrase, best first. A word ending in * matches the words
+            that start with it.
+            """
+        terms = [normalize(term.rstrip('*')) + ('*' if term.endswith('*') else '')
+                 for term in re.findall(r'[\w*]+', phrase)]
+        terms = [term for term in terms if term.strip('*')]
+        if not terms:
+            return []
+
+        with self._lock:
+            scores = None
+            for term in terms:
+                matches = self._matches(language, term)
+                if scores is None:
+                    scores = dict(matches)
+                else:
+                    scores = {table_id: score + matches[table_id]
+                              for table_id, score in scores.items() if table_id in matches}
+                if not scores:
+                    return []
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+_INDEXES_LOCK = threading.Lock()
+
+
+def search_index(catalog):
+    """
+        Returns the SearchIndex of a catalog, built on first use and
+        brought up to date with it.
+        """
+    with _INDEXES_LOCK:
+        index = getattr(catalog, '_search_index', None)
+        if index is None:
+            index = catalog._search_index = SearchIndex(catalog)
+            return index
+    index.update()
+    return index
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+#Coalescing of concurrent identical requests, so that a table is only fetched once at a time
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on windows
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+        Lets only the first of several concurrent calls with the same key do
+        the work; the others wait for it and get its result, or its error.
+
+        Example
+        -------
+
+            flight = SingleFlight(lock_dir="/tmp/ssb_locks")
+            df = flight.do(("read_all", "07161"), lambda: read_all("07161"))
+
+
+        Parameters
+        ----------
+
+        lock_dir: string or None
+            Folder for lock files that also make calls in other processes
+            wait for each other. The process that gets the lock second then
+            does the work again, so this pays off together with a response
+            cache that the processes share. None coalesces within this
+            process only. Needs fcntl (not on windows).
+
+        copy: bool
+            Whether the waiting callers get copies of a DataFrame result
+            rather than the same object. With pandas' copy-on-write the
+            copies are shallow and cheap.
+        """
+
+    def __init__(self, lock_dir=None, copy=True):
+        self.lock_dir = os.path.expanduser(lock_dir) if lock_dir else None
+        self.copy = copy
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key, func):
+        """
+            Returns func(), or the result of the call with the same key that
+            is already in flight.
+            """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                with self._process_lock(key):
+                    call.result = func()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        if leader or not self.copy:
+            return call.result
+        return _copy(call.result)
+
+    @contextmanager
+    def _process_lock(self, key):
+        if self.lock_dir is None or fcntl is None:
+            yield
+            return
+
+        name = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        with open(os.path.join(self.lock_dir, name + '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _copy(result):
+    import pandas as pd
+
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.copy(deep=not _copy_on_write())
+    return result
+
+
+def _copy_on_write():
+    import pandas as pd
+
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    return bool(pd.get_option('mode.copy_on_write'))
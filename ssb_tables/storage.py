@@ -0,0 +1,463 @@
+# coding: utf-8
+
+#Where create_all_tables and refresh_table keep the tables: files in a folder, a SQLite or a DuckDB database
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from .lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+class Storage:
+    """
+        Base class of the places tables are stored. A table is replaced
+        as a whole or not at all: readers never see half of one.
+
+        compact tells get_table whether to hand over the compact dtypes
+        (see compact_dtypes) or the float64 measures of old.
+        """
+
+    compact = True
+
+    def write(self, table_id, df, title=None):
+        """
+            Stores a table, replacing the one stored before. Returns the
+            rows as they were stored.
+            """
+        raise NotImplementedError
+
+    def append(self, table_id, df):
+        """
+            Adds rows to a stored table. Returns the rows as they were
+            stored.
+            """
+        raise NotImplementedError
+
+    def exists(self, table_id):
+        raise NotImplementedError
+
+    def read(self, table_id):
+        raise NotImplementedError
+
+    def columns(self, table_id):
+        raise NotImplementedError
+
+    def values(self, table_id, column):
+        """
+            Returns the distinct values of a column of a stored table, as
+            strings.
+            """
+        raise NotImplementedError
+
+    def write_titles(self, titles):
+        """
+            Stores the codes and titles of the tables, a DataFrame from
+            get_table_titles.
+            """
+        raise NotImplementedError
+
+    def read_manifest(self):
+        """
+            Returns what create_all_tables recorded about the stored
+            tables: per table id the hash of its last download and when
+            Statistics Norway last published it. Empty if nothing is
+            recorded.
+            """
+        raise NotImplementedError
+
+    def write_manifest(self, manifest):
+        raise NotImplementedError
+
+
+class DirectoryStorage(Storage):
+    """
+        Stores each table in a file of its own in a folder,
+        table_{table_id}.{format}, and the titles in titles.csv. Files are
+        written to a temporary file in the same folder first, and renamed
+        over the old one when they are complete.
+
+        Example
+        -------
+
+            storage = DirectoryStorage("tables", format='parquet')
+            create_all_tables(storage=storage)
+
+
+        Parameters
+        ----------
+
+        folder: string
+            The folder, with or without a trailing slash. It is created if
+            it does not exist.
+
+        format: string
+            'csv', 'parquet' or 'feather', see create_all_tables.
+        """
+
+    def __init__(self, folder="tables/", format='csv'):
+        from . import EXPORT_FORMATS
+
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown format {format!r}, expected one of {list(EXPORT_FORMATS)}")
+        self.folder = os.path.expanduser(folder)
+        self.format = format
+        self.compact = format != 'csv'
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, table_id):
+        from . import EXPORT_FORMATS
+        return os.path.join(self.folder, f"table_{table_id}.{EXPORT_FORMATS[self.format]}")
+
+    def _replace(self, path, write, copy_from=None):
+        # Writes to a temporary file next to path, then renames it over path
+        fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.' + os.path.basename(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            if copy_from is not None:
+                shutil.copyfile(copy_from, tmp)
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def write(self, table_id, df, title=None):
+        from . import write_table
+
+        if self.format == 'csv':
+            df = df.astype(str)
+            self._replace(self.path(table_id), lambda tmp: df.to_csv(tmp, index=False))
+        else:
+            self._replace(self.path(table_id),
+                          lambda tmp: write_table(df, tmp, self.format, table_id=table_id, title=title))
+        return df
+
+    def append(self, table_id, df):
+        path = self.path(table_id)
+        if self.format == 'csv':
+            df = df.astype(str)
+            self._replace(path, lambda tmp: df.to_csv(tmp, mode='a', header=False, index=False),
+                          copy_from=path)
+            return df
+
+        from . import read_table
+        stored = read_table(table_id, self.folder, self.format)
+        self.write(table_id, pd.concat([stored, df], ignore_index=True), stored.attrs.get('title'))
+        return df
+
+    def exists(self, table_id):
+        return os.path.exists(self.path(table_id))
+
+    def read(self, table_id):
+        if self.format == 'csv':
+            return pd.read_csv(self.path(table_id), dtype=str)
+        from . import read_table
+        return read_table(table_id, self.folder, self.format)
+
+    def columns(self, table_id):
+        if self.format == 'csv':
+            return list(pd.read_csv(self.path(table_id), dtype=str, nrows=0).columns)
+        import pyarrow.dataset as ds
+        return ds.dataset(self.path(table_id), format='ipc' if self.format == 'feather' else 'parquet').schema.names
+
+    def values(self, table_id, column):
+        if self.format == 'csv':
+            return set(pd.read_csv(self.path(table_id), usecols=[column], dtype=str)[column])
+        from . import read_table
+        return set(read_table(table_id, self.folder, self.format, columns=[column])[column].astype(str))
+
+    def write_titles(self, titles):
+        path = os.path.join(self.folder, "titles.csv")
+        self._replace(path, lambda tmp: titles.astype(str).to_csv(tmp, index=False))
+
+    def read_manifest(self):
+        path = os.path.join(self.folder, "manifest.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        data = json.dumps(manifest, indent=1, sort_keys=True)
+
+        def write(tmp):
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+        self._replace(os.path.join(self.folder, "manifest.json"), write)
+
+
+class _DatabaseStorage(Storage):
+    # What SQLite and DuckDB have in common: a table per table_{table_id},
+    # a titles table, replaced in a transaction. Measures are stored as
+    # doubles (see _widen), counts as integers, whatever the values of the
+    # first rows written.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def _check_whole(self, table_id, df, columns):
+        # Raises rather than round the values that go into an integer column
+        for column in columns:
+            values = df[column].dropna()
+            if pd.api.types.is_float_dtype(values) and (values % 1 != 0).any():
+                raise ValueError(f"Column {column!r} of table {table_id} holds whole numbers, "
+                                 f"it cannot store {values[values % 1 != 0].iloc[0]}")
+
+    def _check_append(self, table_id, df):
+        types = self._column_types(f"table_{table_id}")
+        missing = [column for column in df.columns if column not in types]
+        if missing:
+            raise ValueError(f"Table {table_id} has no columns {missing}")
+        self._check_whole(table_id, df, [column for column in df.columns if 'INT' in types[column].upper()])
+
+    def exists(self, table_id):
+        return f"table_{table_id}" in self._table_names()
+
+    def read(self, table_id):
+        with self._lock:
+            return self._query(f'SELECT * FROM "table_{table_id}"')
+
+    def columns(self, table_id):
+        with self._lock:
+            return list(self._query(f'SELECT * FROM "table_{table_id}" LIMIT 0').columns)
+
+    def values(self, table_id, column):
+        with self._lock:
+            df = self._query(f'SELECT DISTINCT "{column}" FROM "table_{table_id}"')
+        return set(df[column].astype(str))
+
+    def write_titles(self, titles):
+        self.write('titles', titles.astype(str), index=False)
+
+    def read_manifest(self):
+        if 'manifest' not in self._table_names():
+            return {}
+        with self._lock:
+            df = self._query('SELECT * FROM manifest')
+        return {row.pop('table_id'): row for row in df.astype(object).where(df.notna(), None).to_dict('records')}
+
+    def write_manifest(self, manifest):
+        df = pd.DataFrame([{'table_id': table_id, **entry} for table_id, entry in manifest.items()],
+                          columns=['table_id', 'hash', 'updated'])
+        self.write('manifest', df.astype(str).where(df.notna(), None), index=False)
+
+
+class SQLiteStorage(_DatabaseStorage):
+    """
+        Stores the tables in a SQLite database, as tables named
+        table_{table_id} with an index on each dimension column, and the
+        titles in a table called titles. A table is loaded into a new
+        table in one bulk insert, and swapped for the old one in the same
+        transaction.
+
+        Example
+        -------
+
+            storage = SQLiteStorage("tables/ssb.sqlite")
+            create_all_tables(storage=storage)
+            pd.read_sql('SELECT year, AVG(percent) FROM table_07161 GROUP BY year', storage.connection)
+
+
+        Parameters
+        ----------
+
+        path: string
+            File of the database, created if it does not exist.
+        """
+
+    def __init__(self, path):
+        import sqlite3
+
+        super().__init__()
+        self.path = os.path.expanduser(path)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def _table_names(self):
+        with self._lock:
+            return {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    def _query(self, sql):
+        return pd.read_sql_query(sql, self.connection)
+
+    def _column_types(self, name):
+        with self._lock:
+            return {row[1]: row[2] for row in self.connection.execute(f'PRAGMA table_info("{name}")')}
+
+    def write(self, table_id, df, title=None, index=True):
+        name = _table_name(table_id)
+        df = _widen(df)
+        self._check_whole(table_id, df, _counts(df))
+        with self._lock:
+            self.connection.execute('BEGIN')
+            try:
+                self._create(f"{name}__new", df)
+                self._insert(f"{name}__new", df)
+                self.connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+                self.connection.execute(f'ALTER TABLE "{name}__new" RENAME TO "{name}"')
+                if index:
+                    self._index(name, df)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return df
+
+    def append(self, table_id, df):
+        df = _widen(df)
+        self._check_append(table_id, df)
+        with self._lock:
+            self.connection.execute('BEGIN')
+            try:
+                self._insert(f"table_{table_id}", df)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return df
+
+    def _create(self, name, df):
+        types = [_sqlite_type(column, df[column]) for column in df.columns]
+        columns = ", ".join(f'"{column}" {column_type}' for column, column_type in zip(df.columns, types))
+        self.connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+        self.connection.execute(f'CREATE TABLE "{name}" ({columns})')
+
+    def _insert(self, name, df):
+        columns = ", ".join(f'"{column}"' for column in df.columns)
+        placeholders = ", ".join("?" * len(df.columns))
+        self.connection.executemany(f'INSERT INTO "{name}" ({columns}) VALUES ({placeholders})', _rows(df))
+
+    def _index(self, name, df):
+        for column in _dimensions(df):
+            self.connection.execute(f'CREATE INDEX "{name}_{column}" ON "{name}" ("{column}")')
+
+
+class DuckDBStorage(_DatabaseStorage):
+    """
+        Stores the tables in an embedded DuckDB database, laid out like
+        SQLiteStorage. Tables are loaded straight from the DataFrame and
+        replaced in one transaction. Needs duckdb.
+
+        Example
+        -------
+
+            storage = DuckDBStorage("tables/ssb.duckdb")
+            create_all_tables(storage=storage)
+            storage.connection.sql('SELECT year, AVG(percent) FROM table_07161 GROUP BY year').df()
+
+
+        Parameters
+        ----------
+
+        path: string
+            File of the database, created if it does not exist.
+        """
+
+    def __init__(self, path):
+        import duckdb
+
+        super().__init__()
+        self.path = os.path.expanduser(path)
+        self.connection = duckdb.connect(self.path)
+
+    def _table_names(self):
+        with self._lock:
+            return {row[0] for row in self.connection.execute(
+                "SELECT table_name FROM information_schema.tables").fetchall()}
+
+    def _query(self, sql):
+        return self.connection.execute(sql).df()
+
+    def _column_types(self, name):
+        with self._lock:
+            return {row[0]: row[1] for row in self.connection.execute(
+                "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?",
+                [name]).fetchall()}
+
+    def write(self, table_id, df, title=None, index=True):
+        name = _table_name(table_id)
+        df = _widen(df)
+        counts = _counts(df)
+        self._check_whole(table_id, df, counts)
+        with self._lock:
+            self.connection.execute('BEGIN TRANSACTION')
+            try:
+                # dimensions as text rather than enums, so that appended rows
+                # may bring new labels, and measures as doubles, so that they
+                # may bring decimals
+                self.connection.register('new_rows', df)
+                dimensions = _dimensions(df)
+                types = {column: 'VARCHAR' if column in dimensions else 'BIGINT' if column in counts else 'DOUBLE'
+                         for column in df.columns}
+                select = ", ".join(f'CAST("{column}" AS {types[column]}) AS "{column}"' for column in df.columns)
+                self.connection.execute(f'CREATE OR REPLACE TABLE "{name}" AS SELECT {select} FROM new_rows')
+                if index:
+                    for column in _dimensions(df):
+                        self.connection.execute(f'CREATE INDEX "{name}_{column}" ON "{name}" ("{column}")')
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            finally:
+                self.connection.unregister('new_rows')
+        return df
+
+    def append(self, table_id, df):
+        df = _widen(df)
+        self._check_append(table_id, df)
+        with self._lock:
+            self.connection.register('new_rows', df)
+            try:
+                self.connection.execute(f'INSERT INTO "table_{table_id}" BY NAME SELECT * FROM new_rows')
+            finally:
+                self.connection.unregister('new_rows')
+        return df
+
+
+def _table_name(table_id):
+    # The tables have a prefix, so that they stand apart from titles and manifest
+    return table_id if table_id in ('titles', 'manifest') else f"table_{table_id}"
+
+
+def _dimensions(df):
+    # The columns that are not measures
+    return [column for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])]
+
+
+def _widen(df):
+    # float32 measures from compact_dtypes as float64, so that the database
+    # holds 76.1 and not 76.0999984741211
+    from . import _float64
+
+    columns = {column: _float64(df[column]) for column in df.columns
+               if pd.api.types.is_float_dtype(df[column]) and df[column].dtype.itemsize < 8}
+    return df.assign(**columns) if columns else df
+
+
+def _counts(df):
+    # The measures that are counts, see COUNT_MEASURES
+    from . import COUNT_MEASURES
+    return [column for column in df.columns
+            if column in COUNT_MEASURES and pd.api.types.is_numeric_dtype(df[column])]
+
+
+def _sqlite_type(column, values):
+    from . import COUNT_MEASURES
+
+    if not pd.api.types.is_numeric_dtype(values):
+        return 'TEXT'
+    return 'INTEGER' if column in COUNT_MEASURES else 'REAL'
+
+
+def _rows(df):
+    # The rows as tuples of python values, with None for missing ones
+    columns = []
+    for column in df.columns:
+        values = df[column].astype(object)
+        columns.append(values.where(df[column].notna(), None).tolist())
+    return zip(*columns)
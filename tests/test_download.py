@@ -0,0 +1,145 @@
+# coding: utf-8
+
+#Tests of the concurrent download mode of create_all_tables against a local stub of the API
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import ssb_tables
+from ssb_tables import TABLE_SPECS, Metrics, SSBClient, create_all_tables
+from ssb_tables.client import RateLimiter
+
+from benchmarks.fixtures import response_body, synthetic
+
+
+class StubAPI(ThreadingHTTPServer):
+    # Answers the metadata, search and table requests of the API from the
+    # synthetic fixtures, failing the first fail_first requests with 503
+    daemon_threads = True
+
+    def __init__(self, fail_first=0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.fixtures = {table_id: synthetic(table_id) for table_id in TABLE_SPECS}
+        self.fail_first = fail_first
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v0"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, answer):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= server.fail_first
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            # long enough for concurrent requests to overlap
+            time.sleep(0.01)
+            body = None if failing else answer()
+        finally:
+            # before answering, as the client may send the next request then
+            with server.lock:
+                server.in_flight -= 1
+        if failing:
+            self._send(503)
+        else:
+            self._send(200, body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        fixtures = self.server.fixtures
+        if 'query' in parse_qs(url.query):
+            phrase = parse_qs(url.query)['query'][0]
+            results = [{'id': table_id, 'title': fixture['metadata']['title'],
+                        'published': '2019-01-01T00:00:00'}
+                       for table_id, fixture in fixtures.items() if phrase == table_id]
+            return self._answer(lambda: json.dumps(results).encode('utf-8'))
+
+        table_id = url.path.rstrip('/').split('/')[-1]
+        self._answer(lambda: json.dumps(fixtures[table_id]['metadata']).encode('utf-8'))
+
+    def do_POST(self):
+        table_id = urlparse(self.path).path.rstrip('/').split('/')[-1]
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._answer(lambda: response_body(self.server.fixtures[table_id], query))
+
+
+@pytest.fixture
+def stub(request):
+    # The stub, with the client and catalog of ssb_tables pointed at it
+    server = StubAPI(getattr(request, 'param', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    previous = ssb_tables.get_client(), ssb_tables.get_catalog()
+    ssb_tables.set_client(SSBClient(base_url=server.base_url, backoff_factor=0.01))
+    ssb_tables.set_catalog(None)
+    yield server
+    ssb_tables.set_client(previous[0])
+    ssb_tables.set_catalog(previous[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_download_writes_every_table(stub, tmp_path):
+    changed = create_all_tables(str(tmp_path), max_workers=4, max_per_host=2)
+
+    assert changed == sorted(TABLE_SPECS)
+    for table_id in TABLE_SPECS:
+        assert os.path.exists(tmp_path / f"table_{table_id}.csv")
+    assert os.path.exists(tmp_path / "titles.csv")
+    assert stub.max_in_flight <= 2
+
+
+def test_limits_apply_to_the_call_only(stub, tmp_path):
+    client = ssb_tables.get_client()
+    limiter = client.limiter = RateLimiter(3, 1000)
+
+    create_all_tables(str(tmp_path), max_workers=4, max_per_host=1)
+
+    assert stub.max_in_flight == 1
+    assert client.limiter is limiter
+    assert (limiter.max_per_host, limiter.requests_per_second) == (3, 1000)
+
+
+@pytest.mark.parametrize('stub', [3], indirect=True)
+def test_retries_on_service_unavailable(stub, tmp_path):
+    with Metrics() as metrics:
+        create_all_tables(str(tmp_path), max_workers=4)
+
+    assert metrics.to_frame()['retries'].sum() >= 3
+    for table_id in TABLE_SPECS:
+        assert os.path.exists(tmp_path / f"table_{table_id}.csv")
+
+
+def test_second_run_skips_unchanged_tables(stub, tmp_path):
+    create_all_tables(str(tmp_path), max_workers=4)
+    modified = os.path.getmtime(tmp_path / "table_07161.csv")
+
+    assert create_all_tables(str(tmp_path), max_workers=4) == []
+    assert os.path.getmtime(tmp_path / "table_07161.csv") == modified
@@ -0,0 +1,43 @@
+# coding: utf-8
+
+#Tests of the dtypes of compact_dtypes and of the files written by write_table
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssb_tables import compact_dtypes, query, write_table
+
+
+def make_frame(points, pupils):
+    return pd.DataFrame({'region': ['Oslo', 'Bergen'][:len(points)],
+                         'year': ['2017', '2018'][:len(points)],
+                         'points': points,
+                         'pupils': pupils})
+
+
+def test_measure_dtypes_do_not_depend_on_the_values():
+    whole = compact_dtypes(make_frame([41.0, 42.0], [100.0, np.nan]))
+    decimals = compact_dtypes(make_frame([41.5, np.nan], [100.0, 200.0]))
+
+    for df in (whole, decimals):
+        assert df['points'].dtype == np.float32
+        assert df['pupils'].dtype == 'Int32'
+        assert isinstance(df['region'].dtype, pd.CategoricalDtype)
+
+
+def test_counts_must_be_whole_numbers():
+    with pytest.raises(ValueError):
+        compact_dtypes(make_frame([41.0, 42.0], [100.5, 200.0]))
+
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_files_hold_the_published_numbers(tmp_path, format):
+    pytest.importorskip('pyarrow')
+    df = compact_dtypes(make_frame([47.9, 76.1], [100.0, 200.0]))
+    write_table(df, str(tmp_path / f"table_99999.{format}"), format)
+
+    for index in (True, False):
+        for value in (47.9, [47.9], slice(47.9, 47.9)):
+            found = query('99999', {'points': value}, folder=str(tmp_path), format=format, index=index)
+            assert found['points'].tolist() == [47.9]
@@ -0,0 +1,55 @@
+# coding: utf-8
+
+#Tests of sort_table: the rows are put in order without being split up
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from ssb_tables import sort_table
+
+
+def make_frame():
+    # A small table shaped like 07161, with categorical dimensions, in order
+    dims = {'region': ['The whole country', 'Oslo', 'Bergen'],
+            'grade': ['5th grade', '8th grade'],
+            'sex': ['Both sexes', 'Boys', 'Girls'],
+            'year': ['2016', '2017', '2018']}
+    df = pd.DataFrame(list(itertools.product(*dims.values())), columns=list(dims))
+    for column, categories in dims.items():
+        df[column] = pd.Categorical(df[column], categories=categories)
+    df['percent'] = np.arange(len(df), dtype=float)
+    df['pupils'] = np.arange(len(df)) * 10
+    return df
+
+
+def test_sort_keeps_rows_whole():
+    df = make_frame()
+    by = ['region', 'grade', 'sex', 'year']
+    shuffled = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    assert not shuffled.equals(df)
+
+    result = sort_table(shuffled, by)
+
+    # every measure is still on the row of its dimensions
+    before = {tuple(row[:-2]): tuple(row[-2:]) for row in shuffled.itertuples(index=False)}
+    after = {tuple(row[:-2]): tuple(row[-2:]) for row in result.itertuples(index=False)}
+    assert after == before
+    assert result.reset_index(drop=True).equals(df)
+
+
+def test_sort_is_stable_and_puts_missing_last():
+    df = pd.DataFrame({'region': ['b', None, 'a', 'b', 'a'],
+                       'value': [1.0, 2.0, 3.0, 4.0, 5.0]})
+
+    result = sort_table(df, ['region'])
+
+    assert result['region'].tolist()[:4] == ['a', 'a', 'b', 'b']
+    assert pd.isna(result['region'].iloc[-1])
+    assert result['value'].tolist() == [3.0, 5.0, 1.0, 4.0, 2.0]
+
+
+def test_sorted_table_is_returned_as_it_is():
+    df = make_frame()
+    assert sort_table(df, ['region', 'grade', 'sex', 'year']) is df
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+#Tests of the database storages: measures keep their decimals, counts stay whole numbers
+
+import pandas as pd
+import pytest
+
+from ssb_tables import compact_dtypes
+from ssb_tables.storage import DuckDBStorage, SQLiteStorage
+
+
+def make_frame(years, percent, pupils):
+    return compact_dtypes(pd.DataFrame({'region': ['Oslo'] * len(years), 'year': years,
+                                        'percent': percent, 'pupils': pupils}))
+
+
+@pytest.fixture(params=['sqlite', 'duckdb'])
+def storage(request, tmp_path):
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        return DuckDBStorage(str(tmp_path / "ssb.duckdb"))
+    return SQLiteStorage(str(tmp_path / "ssb.sqlite"))
+
+
+def test_appended_decimals_are_kept(storage):
+    # the first rows only hold whole numbers
+    storage.write('07161', make_frame(['2016', '2017'], [12.0, 13.0], [100.0, 200.0]))
+    storage.append('07161', make_frame(['2018', '2019'], [12.5, 13.25], [300.0, None]))
+
+    df = storage.read('07161')
+    assert df['percent'].tolist() == [12.0, 13.0, 12.5, 13.25]
+    assert df['pupils'].tolist()[:3] == [100, 200, 300]
+
+
+def test_measures_are_the_published_numbers(storage):
+    storage.write('07161', make_frame(['2017', '2018'], [76.1, 94.9], [100.0, 200.0]))
+    assert storage.read('07161')['percent'].tolist() == [76.1, 94.9]
+
+
+def test_fractions_are_not_appended_to_counts(storage):
+    storage.write('07161', make_frame(['2016'], [12.0], [100.0]))
+    rows = pd.DataFrame({'region': ['Oslo'], 'year': ['2017'], 'percent': [12.5], 'pupils': [100.5]})
+
+    with pytest.raises(ValueError):
+        storage.append('07161', rows)
+    assert len(storage.read('07161')) == 1